@@ -26,6 +26,7 @@
 # **************************************************************************
 
 import os
+import tempfile
 import pwem
 from pyworkflow.utils import Environ
 
@@ -46,6 +47,14 @@ class Plugin(pwem.Plugin):
         cls._defineVar(RESMAP, 'ResMap-1.95-cuda-Centos7x64')
         cls._defineVar(RESMAP_GPU_LIB, 'ResMap_krnl-cuda-V8.0.61-sm60_gpu.so')
         cls._defineVar(RESMAP_CUDA_LIB, pwem.Config.CUDA_LIB)
+        # Folder for the spectral cache of the in-process engine,
+        # by default inside the project Tmp folder
+        cls._defineVar(RESMAP_CACHE, '')
+        # Socket of the persistent estimation worker, in a folder only
+        # accessible by the user, by default the user runtime folder
+        cls._defineVar(RESMAP_WORKER, '')
+        # Results store shared by the runs, by default one per project
+        cls._defineVar(RESMAP_RESULTS, '')
 
     @classmethod
     def getEnviron(cls):
@@ -69,6 +78,33 @@ class Plugin(pwem.Plugin):
         return os.path.join(cls.getHome('bin'),
                             os.path.basename(cls.getVar(RESMAP_GPU_LIB)))
 
+    @classmethod
+    def getCacheDir(cls, defaultDir):
+        """ Return the spectral cache folder, or defaultDir if the
+        RESMAP_CACHE variable is not set.
+        """
+        return cls.getVar(RESMAP_CACHE) or defaultDir
+
+    @classmethod
+    def getWorkerAddress(cls):
+        """ Return the socket of the persistent estimation worker. By
+        default it is in the user runtime folder (XDG_RUNTIME_DIR) or in
+        a private folder of the system temporary folder.
+        """
+        if cls.getVar(RESMAP_WORKER):
+            return cls.getVar(RESMAP_WORKER)
+        folder = (os.environ.get('XDG_RUNTIME_DIR') or
+                  os.path.join(tempfile.gettempdir(),
+                               'resmap-%d' % os.getuid()))
+        return os.path.join(folder, 'resmap-worker.sock')
+
+    @classmethod
+    def getResultsFile(cls, defaultFile):
+        """ Return the results store file, or defaultFile if the
+        RESMAP_RESULTS variable is not set.
+        """
+        return cls.getVar(RESMAP_RESULTS) or defaultFile
+
     @classmethod
     def defineBinaries(cls, env):
         """ Define required binaries in the given Environment. """
@@ -0,0 +1,135 @@
+# **************************************************************************
+# *
+# * Authors:    Scipion Team (scipion@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Vectorized analysis of local resolution maps.
+"""
+
+import numpy as np
+from scipy.ndimage import map_coordinates
+
+from resmap.constants import RESMAP_BACKGROUND
+from resmap.convert import openMap, createMap
+
+# Slices of the maps processed at once when comparing maps
+DIFF_CHUNK = 16
+# Bin width (Angstroms) of the histogram used for the median difference
+DIFF_BIN = 0.01
+
+
+def sampleVolume(data, coords, samplingRate, origin=(0, 0, 0),
+                 background=None):
+    """ Trilinear interpolation of a volume at the given coordinates.
+    Params:
+        data: volume array (z, y, x).
+        coords: array (n, 3) with the x, y, z coordinates in Angstroms.
+        samplingRate: voxel size in Angstroms.
+        origin: x, y, z position in Angstroms of the first voxel.
+        background: if given, voxels with this value or above are not
+            used in the interpolation. Points with no valid neighbour
+            get NaN.
+    """
+    coords = np.asarray(coords, dtype=np.float64).reshape(-1, 3)
+    # map_coordinates expects one row per axis in (z, y, x) order
+    indexes = ((coords - np.asarray(origin)) / samplingRate)[:, ::-1].T
+
+    if background is None:
+        return map_coordinates(data, indexes, order=1, mode='nearest')
+
+    valid = (data < background).astype(np.float32)
+    values = map_coordinates(np.where(valid > 0, data, 0).astype(np.float32),
+                             indexes, order=1, mode='constant', cval=0)
+    weights = map_coordinates(valid, indexes, order=1,
+                              mode='constant', cval=0)
+    result = np.full(len(coords), np.nan)
+    inside = weights > 1e-6
+    result[inside] = values[inside] / weights[inside]
+    return result
+
+
+def groupMean(values, groups, numberOfGroups=None):
+    """ Mean of values for each group label (0..n-1), ignoring NaN.
+    Groups without any valid value get NaN.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    groups = np.asarray(groups)
+    valid = ~np.isnan(values)
+    sums = np.bincount(groups[valid], weights=values[valid],
+                       minlength=numberOfGroups or 0)
+    counts = np.bincount(groups[valid], minlength=len(sums))
+    means = np.full(len(sums), np.nan)
+    np.divide(sums, counts, out=means, where=counts > 0)
+    return means
+
+
+def diffMapFiles(resAFn, resBFn, outFn, maskFn=None, samplingRate=None,
+                 background=RESMAP_BACKGROUND):
+    """ Write the difference map B - A of two resolution maps, 0 outside
+    the voxels valid in both (and inside the mask, if given). The maps
+    are read and the difference written in chunks of slices. Return a
+    dict with the voxels, mean, median and standard deviation of the
+    difference and the fraction of voxels improved (B better than A)
+    and worsened.
+    """
+    resA, resB = openMap(resAFn), openMap(resBFn)
+    if resA.shape != resB.shape:
+        raise ValueError("Resolution maps of different size: %s and %s"
+                         % (resA.shape, resB.shape))
+    mask = openMap(maskFn) if maskFn else None
+
+    edges = np.arange(-background, background + DIFF_BIN, DIFF_BIN)
+    hist = np.zeros(len(edges) - 1)
+    count, total, squares, improved, worsened = 0, 0.0, 0.0, 0, 0
+    diff = createMap(outFn, resA.shape, samplingRate)
+    for start in range(0, resA.shape[0], DIFF_CHUNK):
+        chunk = slice(start, start + DIFF_CHUNK)
+        a = np.asarray(resA[chunk], dtype=np.float64)
+        b = np.asarray(resB[chunk], dtype=np.float64)
+        valid = (a < background) & (b < background)
+        if mask is not None:
+            valid &= np.asarray(mask[chunk]) > 0
+        values = b[valid] - a[valid]
+        diffChunk = np.zeros(valid.shape, dtype=np.float32)
+        diffChunk[valid] = values
+        diff[chunk] = diffChunk
+        count += values.size
+        total += values.sum()
+        squares += (values ** 2).sum()
+        improved += int(np.count_nonzero(values < 0))
+        worsened += int(np.count_nonzero(values > 0))
+        hist += np.histogram(values, edges)[0]
+
+    diff.flush()
+    del diff
+    if not count:
+        return {'voxels': 0, 'mean': np.nan, 'median': np.nan,
+                'std': np.nan, 'improved': np.nan, 'worsened': np.nan}
+
+    mean = total / count
+    cumulative = np.concatenate([[0], np.cumsum(hist)])
+    return {'voxels': count, 'mean': mean,
+            'median': float(np.interp(count / 2.0, cumulative, edges)),
+            'std': float(np.sqrt(max(squares / count - mean ** 2, 0))),
+            'improved': improved / count, 'worsened': worsened / count}
@@ -0,0 +1,146 @@
+# **************************************************************************
+# *
+# * Authors:    Scipion Team (scipion@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Persistent cache of the spectral intermediates of the in-process engine.
+
+    - Band-pass and window kernels depend only on the box size, the voxel
+      size, the tested resolution and the precision.
+    - Whitened spectra of the half maps depend on the maps content and
+      the precision.
+
+Both are stored as .npy files named after a hash of their key, so reruns
+that only change the p-value or the mask, or maps sharing box and voxel
+size, skip the preprocessing.
+"""
+
+import hashlib
+import os
+import tempfile
+from contextlib import contextmanager
+
+import numpy as np
+
+from resmap.convert import readMap
+
+# Bytes read at once when hashing files
+HASH_BLOCK = 2 ** 24
+
+
+def hashKey(*parts):
+    """ Return a hex digest identifying the given key parts. """
+    return hashlib.sha1(repr(parts).encode()).hexdigest()
+
+
+def hashFiles(*fileNames):
+    """ Return a hex digest of the content of the given files. """
+    digest = hashlib.sha1()
+    for fn in fileNames:
+        with open(os.path.realpath(fn), 'rb') as f:
+            for block in iter(lambda: f.read(HASH_BLOCK), b''):
+                digest.update(block)
+    return digest.hexdigest()
+
+
+@contextmanager
+def atomicFile(fileName):
+    """ Yield a unique temporary file name in the folder of fileName and
+    move it to fileName once written, so concurrent writers of the same
+    file never see or remove each other's partial output.
+    """
+    folder, baseName = os.path.split(os.path.abspath(fileName))
+    fd, tmpFn = tempfile.mkstemp(dir=folder, prefix='.%s.' % baseName,
+                                 suffix='.tmp')
+    os.close(fd)
+    try:
+        yield tmpFn
+        os.replace(tmpFn, fileName)
+    except BaseException:
+        os.remove(tmpFn)
+        raise
+
+
+class SpectralCache:
+    """ Disk cache of kernels and whitened spectra, with an in-memory
+    layer for kernels so long-lived processes reuse them directly.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._kernels = {}
+        os.makedirs(path, exist_ok=True)
+
+    def _getFile(self, prefix, key, suffix=''):
+        return os.path.join(self.path, '%s_%s%s.npy' % (prefix, key, suffix))
+
+    def _load(self, fileNames):
+        if all(os.path.exists(fn) for fn in fileNames):
+            try:
+                return [np.load(fn, mmap_mode='r') for fn in fileNames]
+            except (ValueError, OSError):
+                pass  # incomplete file, it will be computed again
+        return None
+
+    def _save(self, fileNames, arrays):
+        for fn, array in zip(fileNames, arrays):
+            with atomicFile(fn) as tmpFn, open(tmpFn, 'wb') as f:
+                np.save(f, array)
+
+    def getKernels(self, engine, shape, resolution):
+        """ Return the (band, window) kernels of the engine, computing
+        and storing them if needed.
+        """
+        key = hashKey(tuple(shape), engine.samplingRate, float(resolution),
+                      engine.precision)
+        if key not in self._kernels:
+            fileNames = [self._getFile('kernel', key, s)
+                         for s in ('_band', '_window')]
+            kernels = self._load(fileNames)
+            if kernels is None:
+                kernels = engine.computeKernels(shape, resolution)
+                self._save(fileNames, kernels)
+            self._kernels[key] = tuple(kernels)
+        return self._kernels[key]
+
+    def getSpectra(self, engine, half1Fn, half2Fn, half1=None, half2=None):
+        """ Return the whitened spectra of the half maps files, computing
+        and storing them if needed.
+        """
+        key = hashKey(hashFiles(half1Fn, half2Fn), engine.precision)
+        fileNames = [self._getFile('spectra', key, s)
+                     for s in ('_signal', '_noise')]
+        spectra = self._load(fileNames)
+        if spectra is None:
+            if half1 is None:
+                half1, half2 = readMap(half1Fn), readMap(half2Fn)
+            spectra = engine.whiten(half1, half2)
+            self._save(fileNames, spectra)
+        return tuple(spectra)
+
+    def clear(self):
+        """ Remove all cached files. """
+        self._kernels.clear()
+        for fn in os.listdir(self.path):
+            if fn.endswith('.npy'):
+                os.remove(os.path.join(self.path, fn))
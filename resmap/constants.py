@@ -28,6 +28,43 @@ RESMAP = 'RESMAP'
 RESMAP_HOME = 'RESMAP_HOME'
 RESMAP_GPU_LIB = 'RESMAP_GPU_LIB'
 RESMAP_CUDA_LIB = 'RESMAP_CUDA_LIB'
+RESMAP_CACHE = 'RESMAP_CACHE'
+RESMAP_WORKER = 'RESMAP_WORKER'
+RESMAP_RESULTS = 'RESMAP_RESULTS'
 
 CHIMERA_CMD = 'volume1_ori_resmap_chimera.cmd'
 RESMAP_VOL = 'outResmapVol'
+RESULTS_STORE = 'resmap_results.sqlite'
+
+# Value written by ResMap outside the mask. It is not configurable in
+# ResMap 1.95; it is the value its output maps carry outside the mask
+# (the original viewer also relies on it, hiding values above 99.9).
+# Stitching, ROI pasting, the in-process engine and all the statistics
+# use it to tell masked-out voxels, so it must match the binary output.
+RESMAP_BACKGROUND = 100.0
+
+# Tiled execution modes
+TILE_EXEC_STEPS = 0
+TILE_EXEC_LOCAL = 1
+
+# Estimation engines
+ENGINE_BINARY = 0
+ENGINE_PYTHON = 1
+
+# Precision of the in-process engine
+PRECISION_DOUBLE = 0
+PRECISION_SINGLE = 1
+
+# Region of interest modes
+ROI_NONE = 0
+ROI_BOX = 1
+ROI_SPHERE = 2
+ROI_MASK = 3
+
+# Maximum threads used to stage the input files
+STAGING_THREADS = 4
+
+# Seconds without jobs before the estimation worker exits
+WORKER_IDLE_TIMEOUT = 900
+# Seconds waited for a new estimation worker to answer
+WORKER_START_TIMEOUT = 30
@@ -0,0 +1,182 @@
+# **************************************************************************
+# *
+# * Authors:    Scipion Team (scipion@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import os
+import re
+
+import numpy as np
+
+from pwem.constants import NO_INDEX
+from pwem.convert.headers import Ccp4Header
+from pwem.emlib.image import ImageHandler
+from pyworkflow.utils import createAbsLink, cleanPath
+
+# Extensions that ResMap can read directly
+MRC_EXTENSIONS = ['.mrc', '.map', '.ccp4']
+
+
+def readMap(fileName):
+    """ Read a volume file and return its voxels as a numpy array (z, y, x). """
+    return np.asarray(ImageHandler().read(fileName).getData(),
+                      dtype=np.float32)
+
+
+def _getByteOrder(header):
+    """ Byte order ('<' or '>') of an MRC header, from its machine stamp
+    or, for files without a valid one, from the mode value.
+    """
+    if header[212] == 0x44:
+        return '<'
+    if header[212] == 0x11:
+        return '>'
+    mode = np.frombuffer(header[12:16], dtype='<i4')[0]
+    return '<' if 0 <= mode < 2 ** 16 else '>'
+
+
+def openMap(fileName, mode='r'):
+    """ Return the voxels (z, y, x) of a volume file without loading them:
+    a memory map for float32 MRC files (read-only, or writable with mode
+    'r+'), otherwise the array read with readMap.
+    """
+    fileName = fileName.replace(':mrc', '')
+    if os.path.splitext(fileName)[1].lower() in MRC_EXTENSIONS:
+        with open(fileName, 'rb') as f:
+            rawHeader = f.read(1024)
+        order = _getByteOrder(rawHeader)
+        header = np.frombuffer(rawHeader, dtype=order + 'i4')
+        nx, ny, nz, dataMode = header[:4]
+        if dataMode == 2 and min(nx, ny, nz) > 0:
+            offset = 1024 + int(header[23])  # extended header size
+            return np.memmap(fileName, dtype=order + 'f4', mode=mode,
+                             offset=offset, shape=(int(nz), int(ny), int(nx)))
+    if mode != 'r':
+        raise ValueError("%s can not be opened for writing, only float32 "
+                         "MRC files can." % fileName)
+    return readMap(fileName)
+
+
+def createMap(fileName, shape, samplingRate=None):
+    """ Create a float32 MRC volume of the given shape (z, y, x) filled
+    with zeros, without allocating it in memory, and return it opened
+    with openMap for writing.
+    """
+    nz, ny, nx = shape
+    ImageHandler.createEmptyImage(fileName, nx, ny, nz)
+    if samplingRate is not None:
+        header = Ccp4Header(fileName, readHeader=True)
+        header.setSampling(samplingRate)
+        header.writeHeader()
+    return openMap(fileName, 'r+')
+
+
+def writeMap(data, fileName, samplingRate=None):
+    """ Write a numpy array (z, y, x) as a volume file.
+    If samplingRate is given, it is also stored in the map header.
+    """
+    img = ImageHandler().createImage()
+    img.setData(np.ascontiguousarray(data, dtype=np.float32))
+    img.write(fileName)
+
+    if samplingRate is not None:
+        header = Ccp4Header(fileName, readHeader=True)
+        header.setSampling(samplingRate)
+        header.writeHeader()
+
+
+def stageVolume(location, fileName):
+    """ Make the volume at location (index, fileName) available as
+    fileName. Single MRC volumes are linked, other formats are converted.
+    """
+    index, inputFn = location if isinstance(location, (tuple, list)) \
+        else (None, location)
+    inputFn = inputFn.replace(':mrc', '')
+    cleanPath(fileName)
+    # Only whole files can be linked, any image of a stack is extracted
+    if (index in [None, NO_INDEX] and
+            os.path.splitext(inputFn)[1] in MRC_EXTENSIONS):
+        createAbsLink(inputFn, fileName)
+    else:
+        # A new handler per call, so it can be used from several threads
+        ImageHandler().convert(location, fileName)
+    return fileName
+
+
+def checkVolumeHeaders(fileNames):
+    """ Check from the file headers (without reading the voxels) that
+    all volumes have the same dimensions. Return the dimensions or
+    raise ValueError.
+    """
+    dims = [tuple(ImageHandler.getDimensions(fn)[:3]) for fn in fileNames]
+    for fn, dim in zip(fileNames[1:], dims[1:]):
+        if dim != dims[0]:
+            raise ValueError("%s has dimensions %s, while %s has %s"
+                             % (fn, dim, fileNames[0], dims[0]))
+    return dims[0]
+
+
+def getSamplingMismatches(fileNames, samplingRate):
+    """ Return the (fileName, voxel size) of the MRC files whose header
+    voxel size differs from samplingRate.
+    """
+    mismatches = []
+    for fn in fileNames:
+        fn = fn.replace(':mrc', '')
+        if os.path.splitext(fn)[1].lower() in MRC_EXTENSIONS:
+            sampling = Ccp4Header(fn, readHeader=True).getSampling()
+            if not np.allclose(sampling, samplingRate, rtol=1e-3):
+                mismatches.append((fn, sampling))
+    return mismatches
+
+
+def writeResMapLog(logFile, meanRes, medianRes):
+    """ Write a log with the same summary lines that ResMap prints,
+    so results computed by the plugin can be parsed as the binary ones.
+    """
+    with open(logFile, 'w') as f:
+        f.write("MEAN RESOLUTION in MASK = %0.2f\n" % meanRes)
+        f.write("MEDIAN RESOLUTION in MASK = %0.2f\n" % medianRes)
+
+
+def parseResMapLog(logFile):
+    """ Return the mean and median resolution from a ResMap log. """
+    meanRes, medianRes = 0, 0
+    ansi_escape = re.compile(r'\x1B\[[0-?]*[ -/]*[@-~]')
+    with open(logFile, 'r') as f:
+        for line in f:
+            if 'MEAN RESOLUTION in MASK' in line:
+                meanRes = ansi_escape.sub('', line.strip().split('=')[1])
+            elif 'MEDIAN RESOLUTION in MASK' in line:
+                medianRes = ansi_escape.sub('', line.strip().split('=')[1])
+
+    return tuple(map(float, (meanRes, medianRes)))
+
+
+def getResolutionStats(resData, background):
+    """ Return mean and median resolution of the voxels below background. """
+    values = resData[resData < background]
+    if values.size == 0:
+        return 0.0, 0.0
+    return float(values.mean()), float(np.median(values))
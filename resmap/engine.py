@@ -0,0 +1,412 @@
+# **************************************************************************
+# *
+# * Authors:    Scipion Team (scipion@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+In-process local resolution estimation from two half maps.
+
+It is inspired by ResMap (Kucukelbir et al. 2014) but it is a different
+test, not a reimplementation: for each tested resolution, from high to
+low, a local F-test decides if the averaged map contains signal at that
+frequency above the noise estimated from the half maps difference. Each
+voxel gets the first resolution at which the test is significant.
+Results are not expected to match the ResMap binary.
+
+All voxels and resolutions are processed with vectorized FFT operations:
+    - the half maps are pre-whitened with the radial noise spectrum,
+    - a band-pass shell and a Gaussian window (scaled with the tested
+      resolution) give the local signal and noise energies,
+    - their ratio follows an F distribution under the null hypothesis,
+      and p-values are thresholded with the Benjamini-Hochberg procedure.
+
+Computations can run in double or single precision; in single precision
+reductions are accumulated in double to keep the statistics stable.
+
+Directional resolution restricts the band-pass shell to a cone of
+frequencies around a direction, reusing the same whitened spectra for
+all the directions.
+"""
+
+import numpy as np
+import scipy.fft
+from scipy.special import fdtrc
+
+from pwem.emlib.image import ImageHandler
+
+from resmap.cache import SpectralCache
+from resmap.constants import (RESMAP_BACKGROUND, PRECISION_DOUBLE,
+                              PRECISION_SINGLE)
+from resmap.convert import (readMap, writeMap, writeResMapLog,
+                            getResolutionStats)
+
+# Values (voxels) processed at once when evaluating p-values
+CHUNK_SIZE = 2 ** 22
+
+
+# Axes (x, y, z) of the directional tests: the 6 five-fold axes of an
+# icosahedron, evenly covering the half sphere of directions
+_GOLDEN = (1 + np.sqrt(5)) / 2
+DIRECTIONS = np.array([(0, 1, _GOLDEN), (0, -1, _GOLDEN), (1, _GOLDEN, 0),
+                       (-1, _GOLDEN, 0), (_GOLDEN, 0, 1), (-_GOLDEN, 0, 1)])
+DIRECTIONS /= np.linalg.norm(DIRECTIONS, axis=1)[:, None]
+# Half-angle (degrees) of the cones, covering all the directions
+CONE_ANGLE = 37.5
+
+
+class ResolutionEngine:
+    """ Vectorized local resolution estimator.
+    Params:
+        samplingRate: voxel size in Angstroms.
+        minRes, maxRes, stepRes: resolution range to test (Angstroms).
+            As in ResMap, 0 means 2.2 and 4 times the voxel size.
+        precision: PRECISION_DOUBLE or PRECISION_SINGLE.
+        workers: number of threads used by the FFTs.
+        cache: optional SpectralCache to reuse kernels between runs.
+    """
+    def __init__(self, samplingRate, minRes=0, maxRes=0, stepRes=1,
+                 precision=PRECISION_DOUBLE, workers=1, cache=None):
+        self.samplingRate = float(samplingRate)
+        self.minRes = minRes or 2.2 * self.samplingRate
+        self.maxRes = maxRes or 4.0 * self.samplingRate
+        self.stepRes = stepRes
+        self.workers = workers
+        self.cache = cache
+        self._frequencyGrids = {}
+        self.setPrecision(precision)
+
+    def setPrecision(self, precision):
+        self.precision = precision
+        self._frequencyGrids = {}
+        single = precision == PRECISION_SINGLE
+        self.dtype = np.float32 if single else np.float64
+        self.cdtype = np.complex64 if single else np.complex128
+
+    def getResolutions(self):
+        """ Tested resolutions, from high to low (Angstroms). """
+        nyquist = 2 * self.samplingRate
+        resolutions = np.arange(self.minRes, self.maxRes + self.stepRes / 2,
+                                self.stepRes)
+        return resolutions[resolutions > nyquist]
+
+    # ------------------------- Fourier helpers -------------------------------
+    def _rfftn(self, data):
+        return scipy.fft.rfftn(data, workers=self.workers)
+
+    def _irfftn(self, data, shape):
+        return scipy.fft.irfftn(data, s=shape, workers=self.workers)
+
+    def _frequencies(self, shape):
+        """ Modulus of the frequency (cycles/voxel) of the rfft grid. """
+        shape = tuple(shape)
+        if shape not in self._frequencyGrids:
+            axes = [np.fft.fftfreq(n) for n in shape[:-1]]
+            axes.append(np.fft.rfftfreq(shape[-1]))
+            kz, ky, kx = np.meshgrid(*axes, indexing='ij', sparse=True)
+            self._frequencyGrids = {
+                shape: np.sqrt(kz ** 2 + ky ** 2 + kx ** 2).astype(self.dtype)}
+        return self._frequencyGrids[shape]
+
+    def coneWeights(self, shape, direction, angle=CONE_ANGLE):
+        """ Boolean rfft grid of the frequencies within angle (degrees) of
+        the direction (x, y, z) or its opposite.
+        """
+        axes = [np.fft.fftfreq(n) for n in shape[:-1]]
+        axes.append(np.fft.rfftfreq(shape[-1]))
+        kz, ky, kx = np.meshgrid(*axes, indexing='ij', sparse=True)
+        dx, dy, dz = direction
+        projection = np.abs(kx * dx + ky * dy + kz * dz)
+        return projection >= np.cos(np.radians(angle)) * self._frequencies(
+            shape)
+
+    def getKernels(self, shape, resolution):
+        """ Return (band-pass, window) Fourier kernels for a resolution,
+        from the cache if there is one.
+        """
+        if self.cache is not None:
+            return self.cache.getKernels(self, shape, resolution)
+        return self.computeKernels(shape, resolution)
+
+    def computeKernels(self, shape, resolution):
+        """ Return (band-pass, window) Fourier kernels for a resolution.
+        The Gaussian window has a width of one wavelength and the band
+        width is its conjugate, so the number of independent samples in
+        the local test is the same for every resolution.
+        """
+        freq = self._frequencies(shape)
+        f0 = self.samplingRate / resolution
+        sigma = 0.5 * resolution / self.samplingRate  # window, voxels
+        sigmaBand = 1.0 / (2 * np.pi * sigma)
+        # One-sided band: only frequencies at or above the tested one, so
+        # lower resolution signal does not leak into the test
+        band = np.where(freq >= f0,
+                        np.exp(-(freq - f0) ** 2 / (2 * sigmaBand ** 2)), 0)
+        # Fourier transform of a normalized Gaussian window
+        window = np.exp(-2 * np.pi ** 2 * sigma ** 2 * freq ** 2)
+        return band.astype(self.dtype), window.astype(self.dtype)
+
+    @staticmethod
+    def getDegreesOfFreedom(noiseEnergy):
+        """ Effective independent samples of the local test, matching the
+        moments of the local noise energy to a chi-square distribution.
+        """
+        noiseEnergy = noiseEnergy.astype(np.float64)
+        mean = noiseEnergy.mean()
+        var = noiseEnergy.var()
+        return 2 * mean ** 2 / var if var > 0 else 1e6
+
+    def whiten(self, half1, half2):
+        """ Return the Fourier transforms of the average and half
+        difference maps, pre-whitened with the radial noise spectrum.
+        """
+        half1 = np.asarray(half1, dtype=self.dtype)
+        half2 = np.asarray(half2, dtype=self.dtype)
+        shape = half1.shape
+        signal = self._rfftn((half1 + half2) / 2)
+        noise = self._rfftn((half1 - half2) / 2)
+
+        # Radial noise power, accumulated in double precision
+        shells = np.round(self._frequencies(shape) * min(shape)).astype(int)
+        power = np.bincount(shells.ravel(),
+                            weights=np.abs(noise.ravel()) ** 2)
+        counts = np.maximum(np.bincount(shells.ravel()), 1)
+        power = power / counts
+        power[power <= 0] = power[power > 0].min() if np.any(power > 0) else 1
+        whitening = (1.0 / np.sqrt(power)).astype(self.dtype)[shells]
+
+        return (signal * whitening).astype(self.cdtype), \
+               (noise * whitening).astype(self.cdtype)
+
+    # ------------------------- Estimation ------------------------------------
+    def _prepare(self, half1, half2, mask, spectra, shape):
+        shape = tuple(shape or np.shape(half1))
+        if mask is None:
+            mask = np.ones(shape, dtype=bool)
+        spectra = spectra or self.whiten(half1, half2)
+        return shape, np.flatnonzero(mask), spectra
+
+    def _iterPValues(self, spectra, shape, maskIndexes, cone=None):
+        """ Yield (resolution, p-values of the mask voxels) for each tested
+        resolution, computing one resolution at a time.
+        """
+        signal, noise = spectra
+        for resolution in self.getResolutions():
+            band, window = self.getKernels(shape, resolution)
+            if cone is not None:
+                band = band * cone
+            energies = []
+            for spectrum in (signal, noise):
+                filtered = self._irfftn(spectrum * band, shape)
+                local = self._irfftn(self._rfftn(filtered ** 2) * window,
+                                     shape)
+                energies.append(np.maximum(local.ravel(),
+                                           np.finfo(self.dtype).tiny))
+            dof = self.getDegreesOfFreedom(energies[1])
+            energies = [e[maskIndexes] for e in energies]
+            pValues = np.empty(maskIndexes.size, dtype=self.dtype)
+            for start in range(0, maskIndexes.size, CHUNK_SIZE):
+                chunk = slice(start, start + CHUNK_SIZE)
+                ratio = (energies[0][chunk].astype(np.float64) /
+                         energies[1][chunk])
+                pValues[chunk] = fdtrc(dof, dof, ratio)
+            yield resolution, pValues
+
+    def _assign(self, rows, shape, maskIndexes, pVals):
+        """ Build one resolution map per p-value from the (resolution,
+        p-values) rows, from high to low resolution. Each voxel gets the
+        highest resolution at which the test is significant, with the
+        false discovery rate controlled among the voxels still unassigned.
+        Rows are only requested while there are unassigned voxels, and
+        only one row is kept in memory.
+        """
+        results = [np.full(maskIndexes.size, np.nan) for _ in pVals]
+        pendings = [np.ones(maskIndexes.size, dtype=bool) for _ in pVals]
+        for resolution, pValues in rows:
+            for pVal, result, pending in zip(pVals, results, pendings):
+                candidates = np.flatnonzero(pending)
+                threshold = fdrThreshold(pValues[candidates], pVal)
+                accepted = candidates[pValues[candidates] <= threshold]
+                result[accepted] = resolution
+                pending[accepted] = False
+            if not any(pending.any() for pending in pendings):
+                break
+
+        resolutions = self.getResolutions()
+        resMaps = []
+        for result, pending in zip(results, pendings):
+            result[pending] = (resolutions[-1] if len(resolutions)
+                               else self.maxRes)
+            resMap = np.full(shape, RESMAP_BACKGROUND, dtype=np.float32)
+            resMap.ravel()[maskIndexes] = result
+            resMaps.append(resMap)
+        return resMaps
+
+    def estimate(self, half1, half2, mask=None, pVal=0.05, spectra=None,
+                 shape=None, cone=None):
+        """ Return the local resolution map of the two half maps.
+        Whitened spectra (as returned by whiten) and the maps shape can
+        be given instead of the maps to skip their computation. A cone
+        (see coneWeights) restricts the test to the frequencies in a
+        range of directions. The false discovery rate is applied
+        resolution by resolution, so only the p-values of one resolution
+        are kept in memory.
+        """
+        return self.estimateSweep(half1, half2, mask, [pVal], spectra,
+                                  shape, cone)[pVal]
+
+    def estimateSweep(self, half1, half2, mask=None, pVals=(0.05,),
+                      spectra=None, shape=None, cone=None):
+        """ Return a dict {pVal: resolution map} computing the tests once
+        for all the p-values. Arguments as in estimate.
+        """
+        shape, maskIndexes, spectra = self._prepare(half1, half2, mask,
+                                                    spectra, shape)
+        rows = self._iterPValues(spectra, shape, maskIndexes, cone)
+        return dict(zip(pVals, self._assign(rows, shape, maskIndexes,
+                                            pVals)))
+
+    def estimateDirectional(self, half1, half2, mask=None, pVal=0.05,
+                            spectra=None, shape=None, directions=DIRECTIONS,
+                            angle=CONE_ANGLE):
+        """ Return the resolution maps (one per direction, stacked in the
+        first axis) of the tests restricted to cones around directions.
+        """
+        shape = tuple(shape or np.shape(half1))
+        spectra = spectra or self.whiten(half1, half2)
+        resMaps = []
+        for direction in directions:
+            cone = self.coneWeights(shape, direction, angle)
+            resMaps.append(self.estimate(None, None, mask, pVal, spectra,
+                                         shape, cone))
+        return np.stack(resMaps)
+
+
+def getAnisotropy(directionalMaps, background=RESMAP_BACKGROUND):
+    """ Ratio between the worst and the best directional resolution of
+    each voxel (1 for isotropic resolution), background outside the mask.
+    """
+    valid = np.all(directionalMaps < background, axis=0)
+    ratio = np.full(directionalMaps.shape[1:], background, dtype=np.float32)
+    ratio[valid] = (directionalMaps.max(axis=0)[valid] /
+                    directionalMaps.min(axis=0)[valid])
+    return ratio
+
+
+def fdrThreshold(pValues, alpha):
+    """ Benjamini-Hochberg threshold for the given p-values. """
+    if not pValues.size:
+        return -1
+    sortedValues = np.sort(pValues)
+    limits = alpha * np.arange(1, sortedValues.size + 1) / sortedValues.size
+    below = np.flatnonzero(sortedValues <= limits)
+    return sortedValues[below[-1]] if below.size else -1
+
+
+def _loadFiles(half1Fn, half2Fn, maskFn, params):
+    """ Return the engine, whitened spectra, shape and mask of the half
+    maps files. params is consumed (see estimateFiles).
+    """
+    cachePath = params.pop('cachePath', None)
+    cache = params.pop('cache', None)
+    engine = ResolutionEngine(**params)
+    mask = readMap(maskFn) > 0 if maskFn else None
+
+    if cache is None and cachePath:
+        cache = SpectralCache(cachePath)
+    if cache is not None:
+        engine.cache = cache
+        spectra = engine.cache.getSpectra(engine, half1Fn, half2Fn)
+        shape = ImageHandler.getDimensions(half1Fn)[2::-1]
+    else:
+        half1 = readMap(half1Fn)
+        spectra = engine.whiten(half1, readMap(half2Fn))
+        shape = half1.shape
+    return engine, spectra, tuple(shape), mask
+
+
+def estimateFiles(half1Fn, half2Fn, outFn, maskFn, params):
+    """ Estimate the resolution map from files with the given engine
+    parameters (dict with samplingRate, minRes, maxRes, stepRes, pVal,
+    precision, workers and optionally logFn and cachePath, or an already
+    open SpectralCache as cache) and return the mean and median resolution.
+    Defined at module level so it can be sent to worker processes.
+    """
+    params = dict(params)
+    pVal = params.pop('pVal', 0.05)
+    logFn = params.pop('logFn', None)
+    engine, spectra, shape, mask = _loadFiles(half1Fn, half2Fn, maskFn,
+                                              params)
+
+    resMap = engine.estimate(None, None, mask, pVal, spectra, shape)
+    writeMap(resMap, outFn, engine.samplingRate)
+    resStats = getResolutionStats(resMap, RESMAP_BACKGROUND)
+    if logFn:
+        writeResMapLog(logFn, *resStats)
+    return resStats
+
+
+def sweepFiles(half1Fn, half2Fn, outFns, maskFn, params):
+    """ Estimate one resolution map per p-value sharing the test
+    statistics. outFns is a dict {pVal: outputFile} and params as in
+    estimateFiles (pVal and logFn are ignored). Return a dict
+    {pVal: (mean, median)}.
+    """
+    params = dict(params)
+    params.pop('pVal', None)
+    params.pop('logFn', None)
+    engine, spectra, shape, mask = _loadFiles(half1Fn, half2Fn, maskFn,
+                                              params)
+    resMaps = engine.estimateSweep(None, None, mask, list(outFns), spectra,
+                                   shape)
+
+    results = {}
+    for pVal, outFn in outFns.items():
+        writeMap(resMaps[pVal], outFn, engine.samplingRate)
+        results[pVal] = getResolutionStats(resMaps[pVal], RESMAP_BACKGROUND)
+    return results
+
+
+def anisotropyFiles(half1Fn, half2Fn, outFn, maskFn, params, tableFn=None):
+    """ Write the anisotropy map (see getAnisotropy) of the half maps
+    files, with params as in estimateFiles (logFn is ignored), and
+    optionally a table with the mean and median resolution of each
+    direction. Return a list of (direction, mean, median).
+    """
+    params = dict(params)
+    pVal = params.pop('pVal', 0.05)
+    params.pop('logFn', None)
+    engine, spectra, shape, mask = _loadFiles(half1Fn, half2Fn, maskFn,
+                                              params)
+    resMaps = engine.estimateDirectional(None, None, mask, pVal, spectra,
+                                         shape)
+    writeMap(getAnisotropy(resMaps), outFn, engine.samplingRate)
+
+    results = [(tuple(d), ) + getResolutionStats(resMap, RESMAP_BACKGROUND)
+               for d, resMap in zip(DIRECTIONS, resMaps)]
+    if tableFn:
+        with open(tableFn, 'w') as f:
+            f.write("# x y z mean median\n")
+            for direction, mean, median in results:
+                f.write("%0.3f %0.3f %0.3f %0.3f %0.3f\n"
+                        % (direction + (mean, median)))
+    return results
@@ -0,0 +1,113 @@
+# **************************************************************************
+# *
+# * Authors:    Scipion Team (scipion@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Automatic particle mask estimation from the half maps.
+
+The averaged map is low-pass filtered in Fourier space, thresholded
+with a robust estimate of the solvent level and cleaned up keeping the
+largest connected components, filling holes and adding a soft margin.
+Masks are cached by the content of the half maps and the parameters.
+"""
+
+import os
+import shutil
+
+import numpy as np
+import scipy.fft
+from scipy import ndimage
+
+from resmap.cache import hashFiles, hashKey, atomicFile
+from resmap.convert import readMap, writeMap
+
+
+def lowPass(data, samplingRate, resolution):
+    """ Gaussian low-pass filter with its half-maximum at resolution. """
+    shape = data.shape
+    axes = [np.fft.fftfreq(n) for n in shape[:-1]]
+    axes.append(np.fft.rfftfreq(shape[-1]))
+    kz, ky, kx = np.meshgrid(*axes, indexing='ij', sparse=True)
+    freq2 = kz ** 2 + ky ** 2 + kx ** 2
+    cutoff = samplingRate / resolution
+    kernel = np.exp(-np.log(2) * freq2 / cutoff ** 2)
+    return scipy.fft.irfftn(scipy.fft.rfftn(data) * kernel, s=shape)
+
+
+def estimateMask(half1, half2, samplingRate, resolution=15.0,
+                 threshold=3.0, dilation=3, minFraction=0.1):
+    """ Return a boolean mask of the particle.
+    Params:
+        resolution: low-pass filter resolution (Angstroms).
+        threshold: number of robust standard deviations above the solvent
+            level of the low-pass filtered map.
+        dilation: voxels added around the thresholded density.
+        minFraction: connected components smaller than this fraction of
+            the largest one are discarded.
+    """
+    average = (np.asarray(half1, dtype=np.float32) + half2) / 2
+    filtered = lowPass(average, samplingRate,
+                       max(resolution, 2.5 * samplingRate))
+
+    # Most of the box is solvent: median and MAD estimate its level
+    median = np.median(filtered)
+    mad = np.median(np.abs(filtered - median)) * 1.4826
+    mask = filtered > median + threshold * mad
+
+    labels, n = ndimage.label(mask)
+    if n > 1:
+        sizes = np.bincount(labels.ravel())[1:]
+        keep = np.flatnonzero(sizes >= minFraction * sizes.max()) + 1
+        mask = np.isin(labels, keep)
+
+    mask = ndimage.binary_fill_holes(mask)
+    if dilation > 0 and mask.any():
+        ball = ndimage.generate_binary_structure(3, 1)
+        mask = ndimage.binary_dilation(mask, ball, iterations=dilation)
+    return mask
+
+
+def getCachedMask(half1Fn, half2Fn, maskFn, samplingRate, cachePath=None,
+                  **kwargs):
+    """ Write to maskFn the automatic mask of the half maps files,
+    reusing the one in cachePath if it was already computed.
+    Return True if the mask was found in the cache.
+    """
+    cachedFn = None
+    if cachePath:
+        key = hashKey(hashFiles(half1Fn, half2Fn), samplingRate,
+                      sorted(kwargs.items()))
+        cachedFn = os.path.join(cachePath, 'mask_%s.mrc' % key)
+        if os.path.exists(cachedFn):
+            shutil.copyfile(cachedFn, maskFn)
+            return True
+
+    mask = estimateMask(readMap(half1Fn), readMap(half2Fn), samplingRate,
+                        **kwargs)
+    writeMap(mask.astype(np.float32), maskFn, samplingRate)
+    if cachedFn:
+        os.makedirs(cachePath, exist_ok=True)
+        with atomicFile(cachedFn) as tmpFn:
+            shutil.copyfile(maskFn, tmpFn)
+    return False
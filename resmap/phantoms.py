@@ -0,0 +1,63 @@
+# **************************************************************************
+# *
+# * Authors:    Scipion Team (scipion@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Synthetic half maps with known, spatially varying resolution.
+"""
+
+import numpy as np
+from scipy.ndimage import gaussian_filter
+
+
+def makePhantom(size=64, samplingRate=1.0, innerRes=3.0, outerRes=8.0,
+                noise=2.0, seed=0):
+    """ Create two half maps of a spherical particle whose core is at
+    innerRes and whose shell is at outerRes (Angstroms).
+    Returns (half1, half2, mask), arrays of shape (size, size, size).
+    """
+    rng = np.random.RandomState(seed)
+    z, y, x = np.ogrid[:size, :size, :size]
+    center = (size - 1) / 2.0
+    radius = np.sqrt((z - center) ** 2 + (y - center) ** 2 +
+                     (x - center) ** 2) / (size / 2.0)
+    mask = radius < 0.7
+
+    # Random atoms-like density inside the particle
+    density = (rng.random_sample((size,) * 3) < 0.02) * mask
+    density = density.astype(np.float64)
+
+    def lowPass(resolution):
+        # Gaussian with its half-maximum frequency at the resolution
+        sigma = resolution / samplingRate / (2 * np.pi) * np.sqrt(
+            2 * np.log(2))
+        return gaussian_filter(density, sigma)
+
+    inner = radius < 0.4
+    signal = np.where(inner, lowPass(innerRes), lowPass(outerRes))
+    signal /= signal[mask].std()
+
+    half1 = signal + noise * rng.standard_normal(signal.shape)
+    half2 = signal + noise * rng.standard_normal(signal.shape)
+    return half1.astype(np.float32), half2.astype(np.float32), mask
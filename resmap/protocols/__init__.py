@@ -24,4 +24,5 @@
 # *
 # **************************************************************************
 
-from .protocol_resmap import ProtResMap
\ No newline at end of file
+from .protocol_resmap import ProtResMap
+from .protocol_resmap_compare import ProtResMapCompare
@@ -25,17 +25,36 @@
 # *
 # **************************************************************************
 
+import math
 import os
-import re
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import AuthenticationError
+
+import numpy as np
 
 import pyworkflow.protocol.params as params
-from pwem.objects import Volume
+from pyworkflow.protocol.constants import STEPS_PARALLEL
+from pwem.convert.atom_struct import AtomicStructHandler
+from pwem.objects import Volume, VolumeMask, AtomStruct
 from pwem.protocols import ProtAnalysis3D
-from pwem.emlib.image import ImageHandler
-from pyworkflow.utils import exists
+from pyworkflow.utils import exists, makePath
 
 import resmap
 from resmap.constants import *
+from resmap.convert import (readMap, writeMap, writeResMapLog,
+                            getResolutionStats, stageVolume,
+                            checkVolumeHeaders, getSamplingMismatches,
+                            parseResMapLog)
+from resmap.analysis import sampleVolume, groupMean
+from resmap.engine import (estimateFiles, sweepFiles, anisotropyFiles,
+                           DIRECTIONS)
+from resmap.masking import getCachedMask
+from resmap.regions import RegionIndex
+from resmap.store import ResultsStore, getIndexStats, getInputKey
+from resmap.tiling import (planTiles, cropTile, stitchTiles, runTileJob,
+                           LocalExecutor, roiMask, planRegion)
+from resmap.worker import startWorker
 
 
 
@@ -62,6 +81,7 @@ class ProtResMap(ProtAnalysis3D):
 
     def __init__(self, **kwargs):
         ProtAnalysis3D.__init__(self, **kwargs)
+        self.stepsExecutionMode = STEPS_PARALLEL
 
     def _createFilenameTemplates(self):
         """ Centralize the names of the files. """
@@ -72,7 +92,17 @@ class ProtResMap(ProtAnalysis3D):
             'outVol': self._getExtraPath('volume1_ori.map'),
             RESMAP_VOL: self._getExtraPath('volume1_ori_resmap.map'),
             'outChimeraCmd': self._getExtraPath(CHIMERA_CMD),
-            'logFn': self._getExtraPath('ResMaps.log')
+            'logFn': self._getExtraPath('ResMaps.log'),
+            'tileDir': self._getExtraPath('tiles', 'tile_%(tile)03d'),
+            'outAtomStruct': self._getExtraPath('atomstruct_resmap.cif'),
+            'residueRes': self._getExtraPath('residue_resolution.txt'),
+            'regionIndex': self._getExtraPath('volume1_ori_resmap_index.npz'),
+            'roiDir': self._getExtraPath('roi'),
+            'roiMask': self._getExtraPath('roi_mask.map'),
+            'sweepVol': self._getExtraPath('volume1_ori_resmap_p%(pval)s.map'),
+            'sweepLog': self._getExtraPath('pval_sweep.txt'),
+            'anisoVol': self._getExtraPath('volume1_ori_resmap_aniso.map'),
+            'anisoTable': self._getExtraPath('directional_resolution.txt')
         }
         self._updateFilenamesDict(myDict)
 
@@ -122,6 +152,53 @@ class ProtResMap(ProtAnalysis3D):
         form.addParam('maskVolume', params.PointerParam, label="Mask volume",
                       pointerClass='VolumeMask', condition="applyMask",
                       help='Select a volume to apply as a mask.')
+        form.addParam('autoMask', params.BooleanParam, default=False,
+                      condition="not applyMask",
+                      label="Estimate mask in the plugin?",
+                      help="Estimate the mask before running ResMap, by "
+                           "low-pass filtering the averaged half maps, "
+                           "thresholding and keeping the main connected "
+                           "components. The mask is cached by the content "
+                           "of the half maps, so later runs reuse it, and "
+                           "it is registered as an output. If No, ResMap "
+                           "estimates its own mask internally.")
+        form.addParam('roiMode', params.EnumParam, default=ROI_NONE,
+                      choices=['whole volume', 'box', 'sphere', 'mask'],
+                      display=params.EnumParam.DISPLAY_HLIST,
+                      label="Region of interest",
+                      help="Estimate the local resolution only inside a "
+                           "region (a subunit, a ligand pocket...). Only the "
+                           "region plus the margin needed by the test window "
+                           "is processed, so the runtime depends on the "
+                           "region size. The output map has the full size, "
+                           "with the background value outside the region.")
+        line = form.addLine('ROI center (px)',
+                            condition='roiMode in [%d, %d]'
+                                      % (ROI_BOX, ROI_SPHERE),
+                            help='Voxel coordinates of the region center. '
+                                 'Default (-1): center of the volume.')
+        line.addParam('roiX', params.IntParam, default=-1, label='X')
+        line.addParam('roiY', params.IntParam, default=-1, label='Y')
+        line.addParam('roiZ', params.IntParam, default=-1, label='Z')
+        form.addParam('roiSize', params.IntParam, default=32,
+                      condition='roiMode == %d' % ROI_BOX,
+                      label='ROI box size (px)')
+        form.addParam('roiRadius', params.IntParam, default=16,
+                      condition='roiMode == %d' % ROI_SPHERE,
+                      label='ROI radius (px)')
+        form.addParam('roiMaskVolume', params.PointerParam,
+                      pointerClass='VolumeMask',
+                      condition='roiMode == %d' % ROI_MASK,
+                      label='ROI mask',
+                      help='Binary mask defining the region of interest. '
+                           'It must have the same size as the input volumes.')
+        form.addParam('inputAtomStruct', params.PointerParam,
+                      pointerClass='AtomStruct', allowsNull=True,
+                      label="Atomic model (optional)",
+                      help="If provided, the resolution map is sampled at "
+                           "every atom position. The output atomic model "
+                           "stores the local resolution in the B-factor "
+                           "column and a per-residue table is written.")
         form.addParam('show2D', params.BooleanParam, default=True,
                       expertLevel=params.LEVEL_ADVANCED,
                       label="Visualize 2D results?",
@@ -149,33 +226,410 @@ class ProtResMap(ProtAnalysis3D):
                             "0.05 although you are welcome to reduce it (e.g. 0.01) "
                             "if you would like to obtain a more conservative result. "
                             "Empirically, ResMap results are not much affected by the p-value.")
+        group.addParam('doPValSweep', params.BooleanParam, default=False,
+                       expertLevel=params.LEVEL_ADVANCED,
+                       label='Sweep p-values?',
+                       help='Compute the test statistics once and produce '
+                            'one resolution map for each additional p-value, '
+                            'at almost the time and memory of a single run. '
+                            'Only available with the in-process engine.')
+        group.addParam('pValSweep', params.StringParam, default='0.01',
+                       condition='doPValSweep',
+                       expertLevel=params.LEVEL_ADVANCED,
+                       label='Additional p-values',
+                       help='List of p-values separated by spaces or commas, '
+                            'e.g. 0.01 0.001')
         form.addHidden('doBenchmarking', params.BooleanParam, default=False)
 
+        group = form.addGroup('Estimation engine',
+                              expertLevel=params.LEVEL_ADVANCED)
+        group.addParam('engine', params.EnumParam, default=ENGINE_BINARY,
+                       choices=['ResMap binary', 'in-process'],
+                       display=params.EnumParam.DISPLAY_HLIST,
+                       label='Estimation engine',
+                       help='*ResMap binary*: run the ResMap program.\n'
+                            '*in-process*: a different local test, inspired '
+                            'by ResMap, running in the protocol process: a '
+                            'Gaussian band-pass F-test with degrees of '
+                            'freedom matched to the local noise and '
+                            'Benjamini-Hochberg false discovery rate '
+                            'control. It has not been validated against '
+                            'ResMap and its maps are not interchangeable '
+                            'with ResMap results. It uses the protocol '
+                            'threads for the FFTs and does not use the GPU.')
+        group.addParam('precision', params.EnumParam,
+                       default=PRECISION_DOUBLE,
+                       condition='engine == %d' % ENGINE_PYTHON,
+                       choices=['double', 'single'],
+                       display=params.EnumParam.DISPLAY_HLIST,
+                       label='Precision',
+                       help='Floating point precision of the FFTs, local '
+                            'energies and test statistics. Single precision '
+                            'roughly halves the memory of the intermediate '
+                            'arrays, allowing bigger boxes, and is faster. '
+                            'Reductions are always accumulated in double '
+                            'precision.')
+        group.addParam('useSpectralCache', params.BooleanParam, default=False,
+                       condition='engine == %d' % ENGINE_PYTHON,
+                       label='Reuse cached spectra and kernels?',
+                       help='Store the whitened spectra of the half maps '
+                            '(keyed by their content) and the test kernels '
+                            '(keyed by box size, voxel size and resolution) '
+                            'in a cache shared by the runs of the project, '
+                            'so reruns changing only the p-value or the '
+                            'mask, and maps with the same box and voxel '
+                            'size, skip that computation. The folder can be '
+                            'set with the RESMAP_CACHE variable.\n'
+                            'The cache is never cleaned automatically. In '
+                            'double precision it takes about 16 bytes per '
+                            'voxel for the spectra of each pair of half '
+                            'maps, plus 8 bytes per voxel for the kernels '
+                            'of every tested resolution (half of it in '
+                            'single precision). Remove the folder to free '
+                            'the space.')
+        group.addParam('useWorker', params.BooleanParam, default=False,
+                       condition='engine == %d' % ENGINE_PYTHON,
+                       label='Use persistent worker?',
+                       help='Send the estimation to a local worker process '
+                            'that stays alive between runs with the engine '
+                            'and its caches loaded, which removes most of '
+                            'the start overhead when screening many small '
+                            'maps. The worker is started if needed and '
+                            'exits after %d minutes without jobs. Its '
+                            'socket can be set with the RESMAP_WORKER '
+                            'variable, in a folder only accessible by the '
+                            'user. If the worker fails, the estimation '
+                            'runs in the protocol process.'
+                            % (WORKER_IDLE_TIMEOUT // 60))
+        group.addParam('doAnisotropy', params.BooleanParam, default=False,
+                       condition='engine == %d' % ENGINE_PYTHON,
+                       label='Estimate anisotropy?',
+                       help='Repeat the local test restricted to cones of '
+                            'frequencies around %d evenly spaced directions, '
+                            'sharing the whitened spectra of the half maps, '
+                            'and produce a map with the ratio between the '
+                            'worst and the best directional resolution of '
+                            'each voxel (1 means isotropic) and the median '
+                            'resolution of each direction. High values '
+                            'point to preferred orientation artifacts. It '
+                            'takes about %d times the time of the isotropic '
+                            'estimation.' % (len(DIRECTIONS), len(DIRECTIONS)))
+
+        group = form.addGroup('Distributed execution',
+                              expertLevel=params.LEVEL_ADVANCED)
+        group.addParam('doTiling', params.BooleanParam, default=False,
+                       label='Split volume in tiles?',
+                       help='Split the volume in tiles that are estimated '
+                            'as independent jobs and stitched together at '
+                            'the end. Tiles are run in parallel using the '
+                            'protocol threads. With the ResMap binary, if '
+                            'the queue is used for steps, each tile is '
+                            'submitted as a separate queue job; the '
+                            'in-process engine always runs the tiles in the '
+                            'protocol process.\n'
+                            'Providing a mask is recommended, otherwise '
+                            'ResMap estimates a different mask per tile. '
+                            'Tiles outside the mask are skipped.')
+        group.addParam('tilesPerAxis', params.IntParam, default=2,
+                       condition='doTiling',
+                       label='Tiles per axis',
+                       help='Number of tiles along each axis, the volume '
+                            'is split in tilesPerAxis^3 tiles.')
+        group.addParam('tileMargin', params.IntParam, default=0,
+                       condition='doTiling',
+                       label='Tile margin (px)',
+                       help='Extra voxels processed around each tile so the '
+                            'local test window is not truncated at the tile '
+                            'border. Default (0): twice the maximum '
+                            'resolution tested.')
+        group.addParam('tileExecution', params.EnumParam,
+                       default=TILE_EXEC_STEPS,
+                       condition='doTiling',
+                       choices=['protocol steps', 'local processes'],
+                       display=params.EnumParam.DISPLAY_HLIST,
+                       label='Run tiles as',
+                       help='*protocol steps*: one step per tile, run by the '
+                            'protocol threads (or the queue system, only '
+                            'with the ResMap binary).\n'
+                            '*local processes*: a single step runs all tiles '
+                            'in a pool of local processes (one per thread).')
+
+        form.addParallelSection(threads=1, mpi=0)
+
     # --------------------------- INSERT steps functions ----------------------
     def _insertAllSteps(self):
-        inputs = [self.volumeHalf1, self.volumeHalf2]
-        locations = [i.get().getLocation() for i in inputs]
+        locations = {'half1': self.volumeHalf1.get().getLocation(),
+                     'half2': self.volumeHalf2.get().getLocation()}
+        if self.applyMask:
+            locations['mask'] = self.maskVolume.get().getLocation()
+        if self.roiMode == ROI_MASK:
+            locations['roiMask'] = self.roiMaskVolume.get().getLocation()
 
         self._createFilenameTemplates()
-        self._insertFunctionStep('convertInputStep', *locations)
+        convertId = self._insertFunctionStep('stageInputStep', locations)
+        if self._useAutoMask():
+            convertId = self._insertFunctionStep('estimateMaskStep',
+                                                 prerequisites=[convertId])
         args = self._prepareParams()
-        self._insertFunctionStep('estimateResolutionStep', args)
-        self._insertFunctionStep('createOutputStep')
+        if self.doTiling:
+            estimateIds = self._insertTilingSteps(args, convertId)
+        elif self._useRoi():
+            prepareId = self._insertFunctionStep('prepareRoiStep',
+                                                 prerequisites=[convertId])
+            roiId = self._insertFunctionStep('estimateRoiStep', args,
+                                             prerequisites=[prepareId])
+            estimateIds = [self._insertFunctionStep('pasteRoiStep',
+                                                    prerequisites=[roiId])]
+        else:
+            estimateStep = ('estimateSweepStep' if self.doPValSweep
+                            else 'estimateResolutionStep')
+            estimateIds = [self._insertFunctionStep(estimateStep, args,
+                                                    prerequisites=[convertId])]
+        if self.inputAtomStruct.get() is not None:
+            estimateIds = [self._insertFunctionStep('sampleAtomStructStep',
+                                                    prerequisites=estimateIds)]
+        if self._useAnisotropy():
+            estimateIds.append(self._insertFunctionStep(
+                'estimateAnisotropyStep', prerequisites=[convertId]))
+        self._insertFunctionStep('createOutputStep', prerequisites=estimateIds)
+
+    def _insertTilingSteps(self, args, convertId):
+        """ Insert one estimation step per tile (or a single step running
+        all tiles in local processes) and the final stitching step.
+        """
+        prepareId = self._insertFunctionStep('prepareTilesStep',
+                                             prerequisites=[convertId])
+        if self.tileExecution == TILE_EXEC_LOCAL:
+            tileIds = [self._insertFunctionStep('estimateTilesStep', args,
+                                                prerequisites=[prepareId])]
+        else:
+            tileIds = [self._insertFunctionStep('estimateTileStep',
+                                                tile.index, args,
+                                                prerequisites=[prepareId])
+                       for tile in self._getTiles()]
+
+        return [self._insertFunctionStep('stitchTilesStep',
+                                         prerequisites=tileIds)]
 
     # --------------------------- STEPS functions -----------------------------
-    def convertInputStep(self, volLocation1, volLocation2):
-        """ Convert input volume to .mrc as expected by ResMap. """
-        ih = ImageHandler()
-        ih.convert(volLocation1, self._getFileName('half1'))
-        ih.convert(volLocation2, self._getFileName('half2'))
+    def stageInputStep(self, locations):
+        """ Link or convert the input volumes (and masks) to .map as
+        expected by ResMap. Files are staged concurrently after checking
+        their dimensions from the headers. The voxel size of the input
+        objects is always used, header mismatches are only reported.
+        """
+        fileNames = [loc[1] if isinstance(loc, (tuple, list)) else loc
+                     for loc in locations.values()]
+        checkVolumeHeaders(fileNames)
+        samplingRate = self.volumeHalf1.get().getSamplingRate()
+        for fn, sampling in getSamplingMismatches(fileNames, samplingRate):
+            self.warning('%s has voxel size %s in its header, %0.3f is used.'
+                         % (fn, sampling, samplingRate))
+
+        def stage(key):
+            return stageVolume(locations[key], self._getFileName(key))
+
+        with ThreadPoolExecutor(max_workers=STAGING_THREADS) as executor:
+            list(executor.map(stage, locations))
+
+    def estimateMaskStep(self):
+        """ Compute the automatic mask, or reuse it from the cache. """
+        if getCachedMask(self._getFileName('half1'),
+                         self._getFileName('half2'),
+                         self._getFileName('mask'),
+                         self.volumeHalf1.get().getSamplingRate(),
+                         self._getCacheDir()):
+            self.info("Automatic mask found in the cache.")
 
     def estimateResolutionStep(self, args):
         """ Call ResMap with the appropriate parameters. """
+        if self.engine == ENGINE_PYTHON:
+            maskFn = self._getFileName('mask') if self._hasMask() else None
+            self._runEngine('estimate', self._getFileName('half1'),
+                            self._getFileName('half2'),
+                            self._getFileName(RESMAP_VOL), maskFn,
+                            self._getEngineParams(
+                                workers=self.numberOfThreads.get(),
+                                logFn=self._getFileName('logFn')))
+            return
+
         program = resmap.Plugin.getProgram()
         self.runJob(program, args, cwd=self._getExtraPath(),
                     numberOfThreads=1)
 
+    def estimateSweepStep(self, args):
+        """ Estimate the resolution maps for all the p-values sharing the
+        test statistics (in-process engine only).
+        """
+        outFns = {self.pVal.get(): self._getFileName(RESMAP_VOL)}
+        for pVal in self._getSweepPValues():
+            outFns[pVal] = self._getFileName('sweepVol',
+                                             pval=self._getPValSuffix(pVal))
+        maskFn = self._getFileName('mask') if self._hasMask() else None
+        results = self._runEngine('sweep', self._getFileName('half1'),
+                                  self._getFileName('half2'), outFns, maskFn,
+                                  self._getEngineParams(
+                                      workers=self.numberOfThreads.get()))
+
+        writeResMapLog(self._getFileName('logFn'), *results[self.pVal.get()])
+        with open(self._getFileName('sweepLog'), 'w') as f:
+            f.write("# pVal mean median\n")
+            for pVal in sorted(results):
+                f.write("%g %0.3f %0.3f\n" % ((pVal,) + results[pVal]))
+
+    def estimateAnisotropyStep(self):
+        """ Estimate the directional resolution with the in-process
+        engine and write the anisotropy map.
+        """
+        maskFn = self._getFileName('mask') if self._hasMask() else None
+        anisotropyFiles(self._getFileName('half1'), self._getFileName('half2'),
+                        self._getFileName('anisoVol'), maskFn,
+                        self._getEngineParams(
+                            workers=self.numberOfThreads.get()),
+                        self._getFileName('anisoTable'))
+
+    def prepareTilesStep(self):
+        """ Write the half maps (and mask) cropped for every tile.
+        Tiles without any mask voxel are not written and will be skipped.
+        """
+        samplingRate = self.volumeHalf1.get().getSamplingRate()
+        keys = ['half1', 'half2']
+        if self._hasMask():
+            keys.append('mask')
+        volumes = {key: readMap(self._getFileName(key)) for key in keys}
+
+        for tile in self._getTiles():
+            if self._hasMask() and not cropTile(volumes['mask'], tile).any():
+                continue
+            tileDir = self._getFileName('tileDir', tile=tile.index)
+            makePath(tileDir)
+            for key, data in volumes.items():
+                writeMap(cropTile(data, tile),
+                         self._getTileFile(tile.index, key), samplingRate)
+
+    def estimateTileStep(self, tileIndex, args):
+        """ Call ResMap for a single tile. """
+        if not self._hasTileInput(tileIndex):
+            return
+
+        if self.engine == ENGINE_PYTHON:
+            estimateFiles(*self._getTileEngineUnit(tileIndex))
+        else:
+            self.runJob(resmap.Plugin.getProgram(), args,
+                        cwd=self._getFileName('tileDir', tile=tileIndex),
+                        numberOfThreads=1)
+
+    def estimateTilesStep(self, args):
+        """ Call ResMap for all tiles using a pool of local processes. """
+        tileIndexes = [t.index for t in self._getTiles()
+                       if self._hasTileInput(t.index)]
+        executor = LocalExecutor(self.numberOfThreads.get())
+
+        if self.engine == ENGINE_PYTHON:
+            units = [self._getTileEngineUnit(i) for i in tileIndexes]
+            executor.run(estimateFiles, units)
+        else:
+            program = resmap.Plugin.getProgram()
+            env = dict(resmap.Plugin.getEnviron())
+            units = [(program, args, self._getFileName('tileDir', tile=i), env)
+                     for i in tileIndexes]
+            executor.run(runTileJob, units)
+
+    def stitchTilesStep(self):
+        """ Compose the full resolution map from the tile results. """
+        tiles = self._getTiles()
+        results = []
+        for tile in tiles:
+            tileRes = self._getTileFile(tile.index, RESMAP_VOL)
+            results.append(readMap(tileRes) if exists(tileRes) else None)
+
+        resData = stitchTiles(self._getVolumeShape(), tiles, results,
+                              RESMAP_BACKGROUND)
+        writeMap(resData, self._getFileName(RESMAP_VOL),
+                 self.volumeHalf1.get().getSamplingRate())
+        writeResMapLog(self._getFileName('logFn'),
+                       *getResolutionStats(resData, RESMAP_BACKGROUND))
+
+    def prepareRoiStep(self):
+        """ Write the half maps and the region mask cropped to the region
+        of interest plus the test window margin.
+        """
+        samplingRate = self.volumeHalf1.get().getSamplingRate()
+        roi = self._getRoi()
+        region = planRegion(roi, self._getWindowMargin())
+        makePath(self._getFileName('roiDir'))
+        for key in ['half1', 'half2']:
+            writeMap(cropTile(readMap(self._getFileName(key)), region),
+                     self._getRoiFile(key), samplingRate)
+        writeMap(cropTile(roi, region), self._getRoiFile('mask'),
+                 samplingRate)
+
+    def estimateRoiStep(self, args):
+        """ Estimate the resolution in the cropped region of interest. """
+        if self.engine == ENGINE_PYTHON:
+            estimateFiles(self._getRoiFile('half1'),
+                          self._getRoiFile('half2'),
+                          self._getRoiFile(RESMAP_VOL),
+                          self._getRoiFile('mask'),
+                          self._getEngineParams(
+                              workers=self.numberOfThreads.get()))
+        else:
+            self.runJob(resmap.Plugin.getProgram(), args,
+                        cwd=self._getFileName('roiDir'), numberOfThreads=1)
+
+    def pasteRoiStep(self):
+        """ Write the full-size map with the region of interest result. """
+        roi = self._getRoi()
+        region = planRegion(roi, self._getWindowMargin())
+        resData = stitchTiles(roi.shape, [region],
+                              [readMap(self._getRoiFile(RESMAP_VOL))],
+                              RESMAP_BACKGROUND)
+        resData[~roi] = RESMAP_BACKGROUND
+        writeMap(resData, self._getFileName(RESMAP_VOL),
+                 self.volumeHalf1.get().getSamplingRate())
+        writeResMapLog(self._getFileName('logFn'),
+                       *getResolutionStats(resData, RESMAP_BACKGROUND))
+
+    def sampleAtomStructStep(self):
+        """ Sample the resolution map at every atom of the input model.
+        Values are stored in the B-factor column of the output model and
+        averaged per residue.
+        """
+        vol = self.volumeHalf1.get()
+        handler = AtomicStructHandler(self.inputAtomStruct.get().getFileName())
+        atoms = list(handler.getStructure().get_atoms())
+        coords = np.array([atom.get_coord() for atom in atoms])
+
+        residues = {}
+        residueIds = np.array([residues.setdefault(atom.get_parent(),
+                                                   len(residues))
+                               for atom in atoms])
+
+        atomRes = sampleVolume(readMap(self._getFileName(RESMAP_VOL)),
+                               coords, vol.getSamplingRate(),
+                               vol.getShiftsFromOrigin(),
+                               background=RESMAP_BACKGROUND)
+        residueRes = groupMean(atomRes, residueIds, len(residues))
+        atomRes[np.isnan(atomRes)] = RESMAP_BACKGROUND
+
+        for atom, value in zip(atoms, atomRes):
+            atom.set_bfactor(float(value))
+        handler.write(self._getFileName('outAtomStruct'))
+
+        with open(self._getFileName('residueRes'), 'w') as f:
+            f.write("# chain resnum resname resolution\n")
+            for residue, value in zip(residues, residueRes):
+                f.write("%s %d %s %0.3f\n"
+                        % (residue.get_parent().id, residue.id[1],
+                           residue.get_resname(), value))
+
     def createOutputStep(self):
+        # Block summary used for fast region statistics and overviews
+        regionIndex = RegionIndex.build(readMap(self._getFileName(RESMAP_VOL)),
+                                        RESMAP_BACKGROUND)
+        regionIndex.save(self._getFileName('regionIndex'))
+        self._storeResults(regionIndex)
+
         outputVolumeResmap = Volume()
         outputVolumeResmap.setSamplingRate(self.volumeHalf1.get().getSamplingRate())
         outputVolumeResmap.setFileName(self._getFileName(RESMAP_VOL))
@@ -184,6 +638,69 @@ class ProtResMap(ProtAnalysis3D):
         self._defineTransformRelation(self.volumeHalf1, outputVolumeResmap)
         self._defineTransformRelation(self.volumeHalf2, outputVolumeResmap)
 
+        for pVal in self._getSweepPValues():
+            outputVol = Volume()
+            outputVol.setSamplingRate(self.volumeHalf1.get().getSamplingRate())
+            outputVol.setFileName(self._getFileName(
+                'sweepVol', pval=self._getPValSuffix(pVal)))
+            self._defineOutputs(**{'outputVolume_p%s'
+                                   % self._getPValSuffix(pVal): outputVol})
+            self._defineTransformRelation(self.volumeHalf1, outputVol)
+
+        if self._useAnisotropy():
+            outputAnisotropy = Volume()
+            outputAnisotropy.setSamplingRate(
+                self.volumeHalf1.get().getSamplingRate())
+            outputAnisotropy.setFileName(self._getFileName('anisoVol'))
+            self._defineOutputs(outputAnisotropy=outputAnisotropy)
+            self._defineTransformRelation(self.volumeHalf1, outputAnisotropy)
+
+        if self._useAutoMask():
+            outputMask = VolumeMask()
+            outputMask.setSamplingRate(self.volumeHalf1.get().getSamplingRate())
+            outputMask.setFileName(self._getFileName('mask'))
+            self._defineOutputs(outputMask=outputMask)
+            self._defineSourceRelation(self.volumeHalf1, outputMask)
+
+        if self.inputAtomStruct.get() is not None:
+            outputAtomStruct = AtomStruct(
+                filename=self._getFileName('outAtomStruct'))
+            outputAtomStruct.setVolume(outputVolumeResmap)
+            self._defineOutputs(outputAtomStruct=outputAtomStruct)
+            self._defineSourceRelation(self.inputAtomStruct, outputAtomStruct)
+
+    def _storeResults(self, regionIndex):
+        """ Add the statistics of the run to the project results store. """
+        half1, half2 = self.volumeHalf1.get(), self.volumeHalf2.get()
+        maskFn = self._getFileName('mask') if self._hasMask() else None
+        record = {'project': self.getProject().getShortName(),
+                  'runId': self.getObjId(),
+                  'runName': self.getRunName(),
+                  'half1': half1.getFileName(),
+                  'half2': half2.getFileName(),
+                  'mask': maskFn,
+                  'inputKey': getInputKey(half1.getFileName(),
+                                          half2.getFileName(), maskFn),
+                  'samplingRate': half1.getSamplingRate(),
+                  'boxSize': half1.getDim()[0],
+                  'engine': self.getEnumText('engine'),
+                  'minRes': self.minRes.get(),
+                  'maxRes': self.maxRes.get(),
+                  'stepRes': self.stepRes.get(),
+                  'pVal': self.pVal.get(),
+                  'params': self._getEngineParams(
+                      roi=self.getEnumText('roiMode'),
+                      tiles=self.tilesPerAxis.get() if self.doTiling else 0)}
+        record.update(getIndexStats(regionIndex))
+        # exact values, as shown in the summary, instead of the ones
+        # interpolated from the histogram
+        record['mean'], record['median'] = self._parseOutput()
+        record['params'].pop('cachePath', None)
+        try:
+            self.getResultsStore().addRun(record)
+        except sqlite3.Error as e:
+            self.warning('Results store not updated: %s' % e)
+
     # --------------------------- INFO functions ------------------------------
     def _summary(self):
         summary = []
@@ -193,6 +710,29 @@ class ProtResMap(ProtAnalysis3D):
             results = self._parseOutput()
             summary.append('Mean resolution: %0.2f A' % results[0])
             summary.append('Median resolution: %0.2f A' % results[1])
+            if self.engine == ENGINE_PYTHON:
+                summary.append('Estimated in-process (%s precision).'
+                               % self.getEnumText('precision'))
+            if self.doPValSweep and exists(self._getFileName('sweepLog')):
+                summary.append('p-value sweep (pVal: mean, median):')
+                with open(self._getFileName('sweepLog')) as f:
+                    for line in f:
+                        if not line.startswith('#'):
+                            pVal, mean, median = line.split()
+                            summary.append('    %s: %s A, %s A'
+                                           % (pVal, mean, median))
+            anisoTable = self._getFileName('anisoTable')
+            if self._useAnisotropy() and exists(anisoTable):
+                summary.append('Directional resolution (x, y, z: median):')
+                with open(anisoTable) as f:
+                    for line in f:
+                        if not line.startswith('#'):
+                            x, y, z, mean, median = line.split()
+                            summary.append('    %s, %s, %s: %s A'
+                                           % (x, y, z, median))
+            if self.doTiling:
+                summary.append('Estimated in %d tiles.'
+                               % len(self._getTiles()))
         else:
             summary.append("Output is not ready yet.")
 
@@ -205,12 +745,61 @@ class ProtResMap(ProtAnalysis3D):
         if half1.getSamplingRate() != half2.getSamplingRate():
             errors.append(
                 'The selected half volumes have not the same pixel size.')
-        if half1.getXDim() != half2.getXDim():
+        if half1.getDim() != half2.getDim():
             errors.append(
                 'The selected half volumes have not the same dimensions.')
+        if self.applyMask and self.maskVolume.get() is not None:
+            if self.maskVolume.get().getDim() != half1.getDim():
+                errors.append('The mask volume has not the same dimensions '
+                              'as the half volumes.')
+        if self.doTiling and self.tilesPerAxis < 1:
+            errors.append('The number of tiles per axis must be at least 1.')
+        if self.doPValSweep:
+            if self.engine != ENGINE_PYTHON or self.doTiling or self._useRoi():
+                errors.append('The p-value sweep requires the in-process '
+                              'engine on the whole volume.')
+            try:
+                pValues = self._getSweepPValues()
+            except ValueError:
+                pValues = [-1]
+            if not pValues or any(p <= 0 or p >= 1 for p in pValues):
+                errors.append('Additional p-values must be a list of numbers '
+                              'between 0 and 1.')
+        if self.doAnisotropy and self.engine == ENGINE_PYTHON and (
+                self.doTiling or self._useRoi()):
+            errors.append('The anisotropy is only estimated on the whole '
+                          'volume.')
+        if self.doTiling and self._useRoi():
+            errors.append('Tiled execution can not be combined with a '
+                          'region of interest.')
+        if self.roiMode == ROI_MASK:
+            if self.roiMaskVolume.get() is None:
+                errors.append('Please select the mask of the region of '
+                              'interest.')
+            elif self.roiMaskVolume.get().getDim() != half1.getDim():
+                errors.append('The mask of the region of interest has not '
+                              'the same dimensions as the half volumes.')
+        if self.roiMode in [ROI_BOX, ROI_SPHERE]:
+            if any(c >= dim for c, dim in zip(self._getRoiCenter(),
+                                              half1.getDim())):
+                errors.append('The center of the region of interest is '
+                              'outside the volume.')
+        if ((self.roiMode == ROI_BOX and self.roiSize <= 0) or
+                (self.roiMode == ROI_SPHERE and self.roiRadius <= 0)):
+            errors.append('The region of interest must have a positive size.')
 
         return errors
 
+    def _warnings(self):
+        warnings = []
+        if (self.doTiling and self.engine == ENGINE_PYTHON and
+                self.tileExecution == TILE_EXEC_STEPS and
+                self.useQueueForSteps()):
+            warnings.append('Tiles of the in-process engine are not '
+                            'submitted to the queue, they all run in the '
+                            'protocol process.')
+        return warnings
+
     # --------------------------- UTILS functions -----------------------------
     def _prepareParams(self):
         args = " --noguiSplit %(half1)s %(half2)s"
@@ -218,15 +807,11 @@ class ProtResMap(ProtAnalysis3D):
         args += " --pVal=%(pVal)f --maxRes=%(maxRes)f --minRes=%(minRes)f"
         args += " --stepRes=%(stepRes)f"
 
-        if self.show2D:
+        if self.show2D and not self.doTiling:
             args += " --vis2D"
 
-        if self.applyMask:
-            # convert mask to map/ccp4
-            ih = ImageHandler()
-            ih.convert(self.maskVolume.get().getLocation(),
-                       self._getFileName('mask'))
-
+        if self._hasMask() or self._useRoi():
+            # the region of interest is always given as a mask
             args += " --maskVol=%s" % os.path.basename(self._getFileName('mask'))
 
         params = {'half1': os.path.basename(self._getFileName('half1')),
@@ -247,14 +832,160 @@ class ProtResMap(ProtAnalysis3D):
         return args % params
 
     def _parseOutput(self):
-        meanRes, medianRes = 0, 0
-        ansi_escape = re.compile(r'\x1B\[[0-?]*[ -/]*[@-~]')
-        f = open(self._getFileName('logFn'), 'r')
-        for line in f.readlines():
-            if 'MEAN RESOLUTION in MASK' in line:
-                meanRes = ansi_escape.sub('', line.strip().split('=')[1])
-            elif 'MEDIAN RESOLUTION in MASK' in line:
-                medianRes = ansi_escape.sub('', line.strip().split('=')[1])
-        f.close()
-
-        return tuple(map(float, (meanRes, medianRes)))
+        return parseResMapLog(self._getFileName('logFn'))
+
+    def getRegionIndex(self):
+        """ Return the block summary of the resolution map (RegionIndex),
+        or None if it has not been computed.
+        """
+        self._createFilenameTemplates()
+        indexFile = self._getFileName('regionIndex')
+        return RegionIndex.load(indexFile) if exists(indexFile) else None
+
+    def getResultsStore(self):
+        """ Return the results store shared by the runs of the project. """
+        return ResultsStore(resmap.Plugin.getResultsFile(
+            os.path.join(self.getProject().getPath(), RESULTS_STORE)))
+
+    def _getVolumeShape(self):
+        """ Return the input volume shape as (z, y, x). """
+        return tuple(reversed(self.volumeHalf1.get().getDim()))
+
+    def _getWindowMargin(self):
+        """ Voxels added around tiles and the region of interest. The tile
+        margin is only used with tiling, where it is shown in the form.
+        """
+        if self.doTiling and self.tileMargin > 0:
+            return self.tileMargin.get()
+        samplingRate = self.volumeHalf1.get().getSamplingRate()
+        maxRes = self.maxRes.get() or 4 * samplingRate
+        return int(math.ceil(2 * maxRes / samplingRate))
+
+    def _getTiles(self):
+        return planTiles(self._getVolumeShape(), self.tilesPerAxis.get(),
+                         self._getWindowMargin())
+
+    def _getTileFile(self, tileIndex, key):
+        """ Return the tile counterpart of a file in the extra folder. """
+        return os.path.join(self._getFileName('tileDir', tile=tileIndex),
+                            os.path.basename(self._getFileName(key)))
+
+    def _hasTileInput(self, tileIndex):
+        return exists(self._getTileFile(tileIndex, 'half1'))
+
+    def _getSweepPValues(self):
+        """ Additional p-values of the sweep, without the main one. """
+        if not self.doPValSweep:
+            return []
+        values = self.pValSweep.get('').replace(',', ' ').split()
+        return sorted(set(float(v) for v in values) - {self.pVal.get()})
+
+    @staticmethod
+    def _getPValSuffix(pVal):
+        """ Suffix of the files and outputs of a p-value, e.g. 0.01 -> 001 """
+        return ('%g' % pVal).replace('.', '').replace('-', '')
+
+    def _useAnisotropy(self):
+        return self.engine == ENGINE_PYTHON and self.doAnisotropy
+
+    def _useAutoMask(self):
+        return not self.applyMask and self.autoMask
+
+    def _hasMask(self):
+        """ Return True if a mask file is given to the estimation. """
+        return self.applyMask or self._useAutoMask()
+
+    def _getCacheDir(self):
+        """ Cache folder shared by the runs of the project. """
+        return resmap.Plugin.getCacheDir(
+            self.getProject().getTmpPath('resmap_cache'))
+
+    def _useRoi(self):
+        return self.roiMode != ROI_NONE
+
+    def _getRoiCenter(self):
+        """ Center (x, y, z) of the box or sphere region of interest, in
+        voxels. Negative coordinates mean the center of the volume.
+        """
+        dims = self.volumeHalf1.get().getDim()
+        return [c.get() if c.get() >= 0 else (dim - 1) / 2.0
+                for c, dim in zip([self.roiX, self.roiY, self.roiZ], dims)]
+
+    def _getRoi(self):
+        """ Boolean mask (z, y, x) of the region of interest, restricted
+        to the input mask if there is one.
+        """
+        shape = self._getVolumeShape()
+        if self.roiMode == ROI_MASK:
+            roi = readMap(self._getFileName('roiMask')) > 0
+        else:
+            center = self._getRoiCenter()
+            if self.roiMode == ROI_SPHERE:
+                roi = roiMask(shape, center, radius=self.roiRadius.get())
+            else:
+                roi = roiMask(shape, center, size=self.roiSize.get())
+
+        if self._hasMask():
+            roi &= readMap(self._getFileName('mask')) > 0
+        return roi
+
+    def _getRoiFile(self, key):
+        """ Return the region of interest counterpart of an extra file. """
+        return os.path.join(self._getFileName('roiDir'),
+                            os.path.basename(self._getFileName(key)))
+
+    def _getEngineParams(self, **kwargs):
+        """ Parameters of the in-process engine (see engine.estimateFiles).
+        """
+        engineParams = {'samplingRate': self.volumeHalf1.get().getSamplingRate(),
+                        'minRes': self.minRes.get(),
+                        'maxRes': self.maxRes.get(),
+                        'stepRes': self.stepRes.get(),
+                        'pVal': self.pVal.get(),
+                        'precision': self.precision.get()}
+        if self.useSpectralCache:
+            engineParams['cachePath'] = self._getCacheDir()
+        engineParams.update(kwargs)
+        return engineParams
+
+    def _runEngine(self, command, half1Fn, half2Fn, outFns, maskFn,
+                   engineParams):
+        """ Run the 'estimate' or 'sweep' command of the in-process
+        engine, in the persistent worker if selected. If the worker can
+        not be started or the request fails, the command runs in the
+        protocol process.
+        """
+        if self.useWorker:
+            try:
+                return self._runInWorker(command, half1Fn, half2Fn, outFns,
+                                         maskFn, engineParams)
+            except (OSError, EOFError, AuthenticationError,
+                    RuntimeError) as e:
+                self.warning('ResMap worker failed (%s), running in the '
+                             'protocol process.' % e)
+
+        func = estimateFiles if command == 'estimate' else sweepFiles
+        return func(half1Fn, half2Fn, outFns, maskFn, engineParams)
+
+    def _runInWorker(self, command, half1Fn, half2Fn, outFns, maskFn,
+                     engineParams):
+        client = startWorker(resmap.Plugin.getWorkerAddress())
+        absPath = lambda fn: os.path.abspath(fn) if fn else fn
+        if isinstance(outFns, dict):
+            outFns = {k: absPath(fn) for k, fn in outFns.items()}
+        else:
+            outFns = absPath(outFns)
+        engineParams = dict(engineParams)
+        for key in ('cachePath', 'logFn'):
+            if key in engineParams:
+                engineParams[key] = absPath(engineParams[key])
+        return getattr(client, command)(absPath(half1Fn), absPath(half2Fn),
+                                        outFns, absPath(maskFn), engineParams)
+
+    def _getTileEngineUnit(self, tileIndex):
+        """ Arguments of engine.estimateFiles for a tile. """
+        maskFn = self._getTileFile(tileIndex, 'mask') if self._hasMask() else None
+        return (self._getTileFile(tileIndex, 'half1'),
+                self._getTileFile(tileIndex, 'half2'),
+                self._getTileFile(tileIndex, RESMAP_VOL),
+                maskFn, self._getEngineParams())
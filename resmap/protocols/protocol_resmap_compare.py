@@ -0,0 +1,141 @@
+# **************************************************************************
+# *
+# * Authors:    Scipion Team (scipion@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import json
+
+import pyworkflow.protocol.params as params
+from pyworkflow.object import Float, Integer
+from pwem.objects import Volume
+from pwem.protocols import ProtAnalysis3D
+from pyworkflow.utils import exists
+
+from resmap.analysis import diffMapFiles
+
+
+class ProtResMapCompare(ProtAnalysis3D):
+    """
+    Compare two local resolution maps, e.g. ResMap results before and
+    after a refinement. The maps are processed in chunks to compute the
+    difference map (compared minus reference, negative values are
+    improvements) and its statistics.
+    """
+    _label = 'compare local resolution'
+
+    def _createFilenameTemplates(self):
+        """ Centralize the names of the files. """
+        myDict = {
+            'diffVol': self._getExtraPath('resolution_difference.map'),
+            'stats': self._getExtraPath('resolution_difference.json')
+        }
+        self._updateFilenamesDict(myDict)
+
+    # --------------------------- DEFINE param functions ----------------------
+    def _defineParams(self, form):
+        form.addSection(label='Input')
+        form.addParam('resMapReference', params.PointerParam,
+                      pointerClass='Volume',
+                      label="Reference resolution map", important=True,
+                      help='Local resolution map used as reference, e.g. '
+                           'the output of a previous ResMap run.')
+        form.addParam('resMapCompared', params.PointerParam,
+                      pointerClass='Volume',
+                      label="Compared resolution map", important=True,
+                      help='Local resolution map compared with the '
+                           'reference. It must have the same dimensions.')
+        form.addParam('maskVolume', params.PointerParam,
+                      pointerClass='VolumeMask', allowsNull=True,
+                      label="Mask (optional)",
+                      help='Restrict the comparison to the mask. Voxels '
+                           'outside the ResMap mask of either map are '
+                           'always excluded.')
+
+    # --------------------------- INSERT steps functions ----------------------
+    def _insertAllSteps(self):
+        self._createFilenameTemplates()
+        self._insertFunctionStep('compareStep')
+        self._insertFunctionStep('createOutputStep')
+
+    # --------------------------- STEPS functions -----------------------------
+    def compareStep(self):
+        mask = self.maskVolume.get()
+        stats = diffMapFiles(self.resMapReference.get().getFileName(),
+                             self.resMapCompared.get().getFileName(),
+                             self._getFileName('diffVol'),
+                             mask.getFileName() if mask else None,
+                             self.resMapReference.get().getSamplingRate())
+        with open(self._getFileName('stats'), 'w') as f:
+            json.dump(stats, f, indent=1)
+
+    def createOutputStep(self):
+        outputVolume = Volume()
+        outputVolume.setSamplingRate(
+            self.resMapReference.get().getSamplingRate())
+        outputVolume.setFileName(self._getFileName('diffVol'))
+
+        stats = self._getStats()
+        self._defineOutputs(
+            outputVolume=outputVolume,
+            outputVoxels=Integer(stats['voxels']),
+            outputMeanShift=Float(stats['mean']),
+            outputMedianShift=Float(stats['median']),
+            outputFractionImproved=Float(stats['improved']),
+            outputFractionWorsened=Float(stats['worsened']))
+        self._defineSourceRelation(self.resMapReference, outputVolume)
+        self._defineSourceRelation(self.resMapCompared, outputVolume)
+
+    # --------------------------- INFO functions ------------------------------
+    def _summary(self):
+        self._createFilenameTemplates()
+        if not exists(self._getFileName('stats')):
+            return ["Output is not ready yet."]
+
+        stats = self._getStats()
+        return ['Compared voxels: %d' % stats['voxels'],
+                'Mean resolution shift: %0.2f A' % stats['mean'],
+                'Median resolution shift: %0.2f A' % stats['median'],
+                'Improved voxels: %0.1f %%' % (100 * stats['improved']),
+                'Worsened voxels: %0.1f %%' % (100 * stats['worsened'])]
+
+    def _validate(self):
+        errors = []
+        reference = self.resMapReference.get()
+        compared = self.resMapCompared.get()
+        if reference.getDim() != compared.getDim():
+            errors.append('The resolution maps have not the same '
+                          'dimensions.')
+        if reference.getSamplingRate() != compared.getSamplingRate():
+            errors.append('The resolution maps have not the same pixel '
+                          'size.')
+        mask = self.maskVolume.get()
+        if mask is not None and mask.getDim() != reference.getDim():
+            errors.append('The mask volume has not the same dimensions as '
+                          'the resolution maps.')
+        return errors
+
+    # --------------------------- UTILS functions -----------------------------
+    def _getStats(self):
+        with open(self._getFileName('stats')) as f:
+            return json.load(f)
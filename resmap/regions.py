@@ -0,0 +1,278 @@
+# **************************************************************************
+# *
+# * Authors:    Scipion Team (scipion@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Multi-level block summary (chunk pyramid) of a local resolution map.
+
+Level 0 stores, for every block of blockSize^3 voxels, the count, sum,
+min, max and histogram of the voxels inside the mask. Each upper level
+merges 2x2x2 blocks of the previous one, until a single block remains.
+Region queries descend the pyramid only where a block is partially
+covered, so their cost depends on the region surface and not on the
+number of voxels inside.
+"""
+
+import numpy as np
+
+
+class RegionIndex:
+    """ Block summary pyramid over a resolution map. """
+    FIELDS = ['count', 'sum', 'min', 'max', 'hist']
+
+    def __init__(self, shape, blockSize, edges, levels, background):
+        self.shape = tuple(int(d) for d in shape)
+        self.blockSize = int(blockSize)
+        self.background = float(background)
+        self.edges = np.asarray(edges)
+        self.levels = levels  # list of dicts with the FIELDS arrays
+
+    # ------------------------- Build and persistence -------------------------
+    @classmethod
+    def build(cls, data, background, blockSize=8, nbins=120):
+        """ Build the index of a resolution map (z, y, x). Voxels with the
+        background value or above are considered outside the mask.
+        """
+        valid = data < background
+        values = data[valid]
+        if values.size and values.max() > values.min():
+            edges = np.linspace(values.min(), values.max(), nbins + 1)
+        elif values.size:
+            edges = np.linspace(values.min() - 0.5, values.max() + 0.5,
+                                nbins + 1)
+        else:
+            edges = np.linspace(0, 1, nbins + 1)
+        del values
+
+        level0 = cls._buildLevel0(data, valid, blockSize, edges)
+        levels = [level0]
+        while levels[-1]['count'].size > 1:
+            levels.append(cls._mergeLevel(levels[-1]))
+
+        return cls(data.shape, blockSize, edges, levels, background)
+
+    @staticmethod
+    def _blockView(array, blockSize, fill):
+        """ Pad array to a multiple of blockSize and return a view with
+        shape (nz, ny, nx, blockSize^3).
+        """
+        pads = [(0, -d % blockSize) for d in array.shape]
+        array = np.pad(array, pads, constant_values=fill)
+        nz, ny, nx = [d // blockSize for d in array.shape]
+        b = blockSize
+        array = array.reshape(nz, b, ny, b, nx, b).transpose(0, 2, 4, 1, 3, 5)
+        return array.reshape(nz, ny, nx, b ** 3)
+
+    @classmethod
+    def _buildLevel0(cls, data, valid, blockSize, edges):
+        nbins = len(edges) - 1
+        level = None
+        # Process one slab of blocks at a time to bound temporary memory
+        for z0 in range(0, data.shape[0], blockSize):
+            slab = data[z0:z0 + blockSize].astype(np.float64)
+            slabValid = valid[z0:z0 + blockSize]
+            if slab.shape[0] < blockSize:
+                pad = blockSize - slab.shape[0]
+                slab = np.pad(slab, [(0, pad), (0, 0), (0, 0)])
+                slabValid = np.pad(slabValid, [(0, pad), (0, 0), (0, 0)])
+            blocks = cls._blockView(slab, blockSize, 0)[0]
+            blocksValid = cls._blockView(slabValid, blockSize, False)[0]
+
+            bins = np.clip(np.searchsorted(edges, blocks, side='right') - 1,
+                           0, nbins - 1)
+            blockIds = np.arange(blocks.shape[0] * blocks.shape[1])
+            blockIds = blockIds.reshape(blocks.shape[:2] + (1,))
+            flat = (blockIds * nbins + bins)[blocksValid]
+            hist = np.bincount(flat, minlength=blockIds.size * nbins)
+
+            slabLevel = {
+                'count': blocksValid.sum(axis=-1),
+                'sum': np.where(blocksValid, blocks, 0).sum(axis=-1),
+                'min': np.where(blocksValid, blocks, np.inf).min(axis=-1),
+                'max': np.where(blocksValid, blocks, -np.inf).max(axis=-1),
+                'hist': hist.reshape(blocks.shape[:2] + (nbins,))
+            }
+            if level is None:
+                level = {k: [] for k in cls.FIELDS}
+            for k in cls.FIELDS:
+                level[k].append(slabLevel[k])
+
+        return {k: np.stack(v) for k, v in level.items()}
+
+    @staticmethod
+    def _mergeLevel(level):
+        """ Merge 2x2x2 blocks of a level into the next one. """
+        def merge(array, fill, reduce):
+            pads = [(0, d % 2) for d in array.shape[:3]]
+            pads += [(0, 0)] * (array.ndim - 3)
+            array = np.pad(array, pads, constant_values=fill)
+            nz, ny, nx = [d // 2 for d in array.shape[:3]]
+            array = array.reshape((nz, 2, ny, 2, nx, 2) + array.shape[3:])
+            return reduce(array, axis=(1, 3, 5))
+
+        return {
+            'count': merge(level['count'], 0, np.sum),
+            'sum': merge(level['sum'], 0, np.sum),
+            'min': merge(level['min'], np.inf, np.min),
+            'max': merge(level['max'], -np.inf, np.max),
+            'hist': merge(level['hist'], 0, np.sum)
+        }
+
+    def save(self, fileName):
+        arrays = {'shape': np.array(self.shape),
+                  'blockSize': np.array(self.blockSize),
+                  'background': np.array(self.background),
+                  'edges': self.edges}
+        for i, level in enumerate(self.levels):
+            for k in self.FIELDS:
+                arrays['%s_%d' % (k, i)] = level[k]
+        # use an open file so numpy does not append the .npz extension
+        with open(fileName, 'wb') as f:
+            np.savez_compressed(f, **arrays)
+
+    @classmethod
+    def load(cls, fileName):
+        with np.load(fileName) as f:
+            nlevels = len([k for k in f.files if k.startswith('count_')])
+            levels = [{k: f['%s_%d' % (k, i)] for k in cls.FIELDS}
+                      for i in range(nlevels)]
+            return cls(f['shape'], int(f['blockSize']), f['edges'], levels,
+                       float(f['background']))
+
+    # ------------------------- Queries ---------------------------------------
+    def query(self, start=(0, 0, 0), stop=None, data=None):
+        """ Return the statistics of the voxels inside the box [start, stop)
+        (z, y, x voxel indexes). Blocks partially covered by the box are
+        computed exactly from data (that can be a memory-mapped volume).
+        If data is not given, they contribute proportionally to the
+        covered fraction: count, sum and histogram are then approximate
+        (counts may not be integers) and min and max are not reported
+        (NaN), since they could come from voxels outside the box. The
+        'exact' key of the result tells which case applies.
+        """
+        start = np.maximum(np.asarray(start, dtype=int), 0)
+        stop = np.minimum(np.asarray(self.shape if stop is None else stop,
+                                     dtype=int), self.shape)
+        stats = {'count': 0., 'sum': 0., 'min': np.inf, 'max': -np.inf,
+                 'hist': np.zeros(len(self.edges) - 1), 'exact': True}
+        if np.any(stop <= start):
+            return self._finalize(stats)
+
+        top = len(self.levels) - 1
+        pending = [(top, (0, 0, 0))]
+        while pending:
+            level, block = pending.pop()
+            size = self.blockSize * 2 ** level
+            blockStart = np.array(block) * size
+            blockStop = np.minimum(blockStart + size, self.shape)
+            lo = np.maximum(blockStart, start)
+            hi = np.minimum(blockStop, stop)
+            counts = self.levels[level]['count']
+            if np.any(hi <= lo) or any(i >= n for i, n in zip(block,
+                                                               counts.shape)):
+                continue
+            summary = {k: self.levels[level][k][block] for k in self.FIELDS}
+            if summary['count'] == 0:
+                continue
+
+            if np.all(lo == blockStart) and np.all(hi == blockStop):
+                self._accumulate(stats, summary)
+            elif level > 0:
+                z, y, x = [2 * i for i in block]
+                pending.extend((level - 1, (z + dz, y + dy, x + dx))
+                               for dz in (0, 1) for dy in (0, 1)
+                               for dx in (0, 1))
+            elif data is not None:
+                region = tuple(slice(a, b) for a, b in zip(lo, hi))
+                self._accumulate(stats, self._voxelSummary(data[region]))
+            else:
+                fraction = (np.prod(hi - lo) /
+                            float(np.prod(blockStop - blockStart)))
+                self._accumulate(stats, summary, fraction)
+                stats['exact'] = False
+
+        if not stats['exact']:
+            stats['min'] = stats['max'] = np.nan
+        return self._finalize(stats)
+
+    def _voxelSummary(self, values):
+        values = np.asarray(values, dtype=np.float64)
+        values = values[values < self.background]
+        hist, _ = np.histogram(values, self.edges)
+        return {'count': values.size, 'sum': values.sum(),
+                'min': values.min() if values.size else np.inf,
+                'max': values.max() if values.size else -np.inf,
+                'hist': hist}
+
+    @staticmethod
+    def _accumulate(stats, summary, fraction=1.0):
+        stats['count'] += summary['count'] * fraction
+        stats['sum'] += summary['sum'] * fraction
+        stats['min'] = min(stats['min'], summary['min'])
+        stats['max'] = max(stats['max'], summary['max'])
+        stats['hist'] = stats['hist'] + summary['hist'] * fraction
+
+    def _finalize(self, stats):
+        count = stats['count']
+        stats['mean'] = stats['sum'] / count if count else np.nan
+        stats['median'] = self.percentile(stats['hist'], 50)
+        stats['edges'] = self.edges
+        return stats
+
+    def percentile(self, hist, q):
+        """ Percentile estimated from a histogram, interpolating in bins. """
+        cumulative = np.cumsum(hist)
+        if not len(cumulative) or cumulative[-1] <= 0:
+            return np.nan
+        return float(np.interp(q / 100. * cumulative[-1],
+                               np.concatenate([[0], cumulative]), self.edges))
+
+    def rebin(self, hist, nbins):
+        """ Return the (hist, edges) of a histogram of the index in nbins
+        bins over the same range. It is exact when the number of bins of
+        the index is a multiple of nbins.
+        """
+        edges = np.linspace(self.edges[0], self.edges[-1], nbins + 1)
+        cumulative = np.concatenate([[0], np.cumsum(hist)])
+        return np.diff(np.interp(edges, self.edges, cumulative)), edges
+
+    def fractionBelow(self, hist, threshold):
+        """ Fraction of the histogram counts below threshold
+        (e.g. voxels better than 4 A).
+        """
+        cumulative = np.concatenate([[0], np.cumsum(hist)])
+        if cumulative[-1] <= 0:
+            return np.nan
+        return float(np.interp(threshold, self.edges, cumulative)
+                     / cumulative[-1])
+
+    def overview(self, level):
+        """ Downsampled mean resolution map of the given level (NaN outside
+        the mask).
+        """
+        summary = self.levels[level]
+        result = np.full(summary['count'].shape, np.nan)
+        np.divide(summary['sum'], summary['count'], out=result,
+                  where=summary['count'] > 0)
+        return result
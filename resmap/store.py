@@ -0,0 +1,198 @@
+# **************************************************************************
+# *
+# * Authors:    Scipion Team (scipion@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Project-level store of the statistics of ResMap runs.
+
+Each run appends one row to an SQLite table with its resolution summary
+(mean, median, percentiles and histogram, taken from the RegionIndex),
+its parameters and the identity of its inputs, so many runs can be
+compared without opening the protocols or reading any map.
+"""
+
+import json
+import os
+import sqlite3
+import time
+from contextlib import closing
+
+import numpy as np
+
+from resmap.cache import hashKey
+
+# Percentiles stored for each run
+PERCENTILES = (5, 25, 75, 95)
+
+# Columns of the runs table, besides the histogram
+COLUMNS = [('project', 'TEXT'), ('runId', 'INTEGER'), ('runName', 'TEXT'),
+           ('timestamp', 'REAL'), ('half1', 'TEXT'), ('half2', 'TEXT'),
+           ('mask', 'TEXT'), ('inputKey', 'TEXT'), ('samplingRate', 'REAL'),
+           ('boxSize', 'INTEGER'), ('engine', 'TEXT'), ('minRes', 'REAL'),
+           ('maxRes', 'REAL'), ('stepRes', 'REAL'), ('pVal', 'REAL'),
+           ('voxels', 'INTEGER'), ('mean', 'REAL'), ('median', 'REAL')]
+COLUMNS += [('p%d' % q, 'REAL') for q in PERCENTILES]
+COLUMNS += [('min', 'REAL'), ('max', 'REAL'), ('params', 'TEXT')]
+COLUMN_NAMES = [name for name, _ in COLUMNS]
+
+
+def getInputKey(*fileNames):
+    """ Identity of the input files from their path, size and
+    modification time, without reading them.
+    """
+    parts = []
+    for fn in fileNames:
+        if fn and os.path.exists(fn):
+            st = os.stat(fn)
+            parts.append((os.path.realpath(fn), st.st_size, st.st_mtime))
+        else:
+            parts.append(fn)
+    return hashKey(*parts)
+
+
+def getIndexStats(index):
+    """ Summary statistics of a whole RegionIndex: voxels, mean, median,
+    percentiles, min, max and the histogram with its edges. The median
+    and the percentiles are interpolated from the histogram, so they are
+    accurate to the bin width.
+    """
+    stats = index.query()
+    summary = {'voxels': int(stats['count']),
+               'mean': float(stats['mean']),
+               'median': float(stats['median']),
+               'min': float(stats['min']) if stats['count'] else np.nan,
+               'max': float(stats['max']) if stats['count'] else np.nan,
+               'hist': np.asarray(stats['hist'], dtype=np.float64),
+               'edges': np.asarray(stats['edges'], dtype=np.float64)}
+    for q in PERCENTILES:
+        summary['p%d' % q] = index.percentile(stats['hist'], q)
+    return summary
+
+
+class ResultsStore:
+    """ SQLite table with one row per (project, runId). Connections are
+    opened per operation, so it can be used from several threads and
+    processes.
+    """
+    def __init__(self, fileName):
+        self.fileName = fileName
+        with closing(self._connect()) as conn, conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS runs (%s, '
+                         'hist BLOB, edges BLOB, UNIQUE(project, runId))'
+                         % ', '.join('%s %s' % c for c in COLUMNS))
+            for column in ('timestamp', 'inputKey', 'median'):
+                conn.execute('CREATE INDEX IF NOT EXISTS runs_%s '
+                             'ON runs (%s)' % (column, column))
+
+    def _connect(self):
+        conn = sqlite3.connect(self.fileName, timeout=30)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    @staticmethod
+    def _checkColumns(columns):
+        unknown = set(columns) - set(COLUMN_NAMES)
+        if unknown:
+            raise ValueError('Unknown columns: %s' % ', '.join(sorted(unknown)))
+
+    def addRun(self, record):
+        """ Insert or replace the row of a run. record is a dict with
+        values for COLUMN_NAMES (params may be a dict), plus optionally
+        hist and edges arrays.
+        """
+        record = dict(record)
+        record.setdefault('timestamp', time.time())
+        if isinstance(record.get('params'), dict):
+            record['params'] = json.dumps(record['params'], sort_keys=True)
+        for key in ('hist', 'edges'):
+            if record.get(key) is not None:
+                record[key] = np.asarray(record[key], np.float64).tobytes()
+        columns = [c for c in COLUMN_NAMES + ['hist', 'edges']
+                   if c in record]
+        with closing(self._connect()) as conn, conn:
+            conn.execute('INSERT OR REPLACE INTO runs (%s) VALUES (%s)'
+                         % (', '.join(columns), ', '.join('?' * len(columns))),
+                         [record[c] for c in columns])
+
+    def removeRun(self, project, runId):
+        with closing(self._connect()) as conn, conn:
+            conn.execute('DELETE FROM runs WHERE project = ? AND runId = ?',
+                         (project, runId))
+
+    def query(self, columns=None, since=None, until=None, limit=None,
+              **filters):
+        """ Return the rows (dicts) of the runs in time order.
+        Params:
+            columns: list of columns to return (default all but the
+                histogram).
+            since, until: timestamps limits.
+            limit: maximum number of rows, the most recent ones.
+            filters: column=value equality conditions.
+        """
+        columns = list(columns or COLUMN_NAMES)
+        self._checkColumns(columns + list(filters))
+        conditions, values = [], []
+        for column, value in filters.items():
+            conditions.append('%s = ?' % column)
+            values.append(value)
+        if since is not None:
+            conditions.append('timestamp >= ?')
+            values.append(since)
+        if until is not None:
+            conditions.append('timestamp <= ?')
+            values.append(until)
+
+        sql = 'SELECT %s FROM runs' % ', '.join(columns)
+        if conditions:
+            sql += ' WHERE ' + ' AND '.join(conditions)
+        sql += ' ORDER BY timestamp DESC'
+        if limit is not None:
+            sql += ' LIMIT %d' % int(limit)
+
+        with closing(self._connect()) as conn:
+            rows = [dict(row) for row in conn.execute(sql, values)]
+        rows.reverse()
+        if 'params' in columns:
+            for row in rows:
+                row['params'] = json.loads(row['params'] or '{}')
+        return rows
+
+    def getTrend(self, column, **kwargs):
+        """ Return (timestamps, values) arrays of a column over the runs
+        selected as in query.
+        """
+        rows = self.query(['timestamp', column], **kwargs)
+        return (np.array([r['timestamp'] for r in rows], dtype=np.float64),
+                np.array([r[column] for r in rows], dtype=np.float64))
+
+    def getHistogram(self, project, runId):
+        """ Return the (hist, edges) of a run, or None if not stored. """
+        with closing(self._connect()) as conn:
+            row = conn.execute('SELECT hist, edges FROM runs WHERE '
+                               'project = ? AND runId = ?',
+                               (project, runId)).fetchone()
+        if row is None or row['hist'] is None:
+            return None
+        return (np.frombuffer(row['hist'], dtype=np.float64),
+                np.frombuffer(row['edges'], dtype=np.float64))
@@ -0,0 +1,88 @@
+# **************************************************************************
+# *
+# * Authors:    Scipion Team (scipion@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import os
+import tempfile
+
+import numpy as np
+from pyworkflow.tests import BaseTest
+
+from resmap.analysis import sampleVolume, groupMean, diffMapFiles
+from resmap.convert import readMap, writeMap
+
+
+class TestAtomSampling(BaseTest):
+    def testSampleLinearMap(self):
+        # trilinear interpolation is exact for a linear function
+        z, y, x = np.mgrid[0:20, 0:20, 0:20].astype(np.float32)
+        data = 2 * x + 3 * y + 0.5 * z
+        samplingRate, origin = 1.5, (-3., 1.5, 0.)
+        coords = np.random.uniform(2, 25, size=(1000, 3))
+        values = sampleVolume(data, coords, samplingRate, origin)
+        idx = (coords - origin) / samplingRate
+        expected = 2 * idx[:, 0] + 3 * idx[:, 1] + 0.5 * idx[:, 2]
+        self.assertTrue(np.allclose(values, expected, atol=1e-3))
+
+    def testSampleBackground(self):
+        data = np.full((10, 10, 10), 100, dtype=np.float32)
+        data[:, :, :5] = 4.0
+        values = sampleVolume(data, [[4.5, 5, 5], [8, 5, 5], [50, 50, 50]],
+                              1.0, background=100)
+        # background voxels do not blend into valid ones
+        self.assertAlmostEqual(values[0], 4.0, 5)
+        self.assertTrue(np.isnan(values[1]))
+        self.assertTrue(np.isnan(values[2]))
+
+    def testGroupMean(self):
+        means = groupMean([1, 3, np.nan, 5, np.nan], [0, 0, 1, 1, 2], 4)
+        self.assertEqual(means[0], 2)
+        self.assertEqual(means[1], 5)
+        self.assertTrue(np.isnan(means[2]) and np.isnan(means[3]))
+
+
+class TestMapDifference(BaseTest):
+    def testDiffMapFiles(self):
+        tmpDir = tempfile.mkdtemp()
+        np.random.seed(0)
+        resA = np.random.uniform(3, 8, (40, 30, 20)).astype(np.float32)
+        resB = resA + np.random.normal(0, 0.5, resA.shape).astype(np.float32)
+        resA[:5] = 100
+        resB[:, :3] = 100
+        fns = [os.path.join(tmpDir, fn) for fn in ('a.map', 'b.map', 'd.map')]
+        writeMap(resA, fns[0], 1.0)
+        writeMap(resB, fns[1], 1.0)
+
+        stats = diffMapFiles(fns[0], fns[1], fns[2], samplingRate=1.0)
+        valid = (resA < 100) & (resB < 100)
+        diff = (resB - resA)[valid]
+        self.assertEqual(stats['voxels'], diff.size)
+        self.assertAlmostEqual(stats['mean'], diff.mean(), 5)
+        self.assertAlmostEqual(stats['median'], np.median(diff), 2)
+        self.assertAlmostEqual(stats['improved'], np.mean(diff < 0), 5)
+
+        diffMap = readMap(fns[2])
+        self.assertTrue(np.allclose(diffMap[valid], diff))
+        self.assertTrue(np.all(diffMap[~valid] == 0))
@@ -0,0 +1,86 @@
+# **************************************************************************
+# *
+# * Authors:    Scipion Team (scipion@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import threading
+
+from pyworkflow.tests import BaseTest
+
+from resmap.viewers.background import BackgroundTasks
+
+
+class TestBackgroundTasks(BaseTest):
+    def setUp(self):
+        self.tasks = BackgroundTasks()
+        self.release = threading.Event()
+        self.calls = 0
+
+    def tearDown(self):
+        self.release.set()
+        self.tasks.shutdown()
+
+    def load(self, task):
+        self.calls += 1
+        task.setProgress(0.5, 'loading')
+        while not self.release.wait(0.01):
+            task.checkCancelled()
+        return 'data'
+
+    def testCoalescing(self):
+        results = []
+        first = self.tasks.submit('load', self.load, results.append)
+        second = self.tasks.submit('load', self.load,
+                                   lambda data: results.append(data + '2'))
+        self.assertIs(first, second)
+        self.assertTrue(self.tasks.deliver())  # still running
+        self.assertEqual(results, [])
+
+        self.release.set()
+        self.tasks.wait('load')
+        self.assertFalse(self.tasks.deliver())
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(results, ['data', 'data2'])
+        self.assertEqual(first.progress, 0.5)
+
+    def testCancel(self):
+        results = []
+        task = self.tasks.submit('load', self.load, results.append)
+        self.tasks.cancel('load')
+        self.assertTrue(task.isCancelled())
+        if not task.future.cancelled():
+            task.future.exception(timeout=10)  # it stops by itself
+        self.assertFalse(self.tasks.deliver())
+        self.assertEqual(results, [])
+
+    def testError(self):
+        errors = []
+
+        def fail(task):
+            raise ValueError('broken map')
+
+        self.tasks.submit('fail', fail, None, errors.append)
+        self.tasks.wait('fail')
+        self.tasks.deliver()
+        self.assertEqual(str(errors[0]), 'broken map')
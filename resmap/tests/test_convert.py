@@ -0,0 +1,95 @@
+# **************************************************************************
+# *
+# * Authors:    Scipion Team (scipion@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import os
+import tempfile
+
+import numpy as np
+from pyworkflow.tests import BaseTest
+
+from resmap.convert import (readMap, writeMap, stageVolume,
+                            checkVolumeHeaders, getSamplingMismatches,
+                            openMap, createMap)
+
+
+class TestStaging(BaseTest):
+    @classmethod
+    def setUpClass(cls):
+        cls.tmpDir = tempfile.mkdtemp()
+        cls.data = np.random.rand(12, 12, 12).astype(np.float32)
+        cls.volFn = cls._tmp('input.mrc')
+        writeMap(cls.data, cls.volFn, 1.5)
+
+    @classmethod
+    def _tmp(cls, fn):
+        return os.path.join(cls.tmpDir, fn)
+
+    def testStageLinksMrc(self):
+        outFn = self._tmp('volume1.map')
+        stageVolume((0, self.volFn + ':mrc'), outFn)
+        self.assertTrue(os.path.islink(outFn))
+        # staging again (e.g. when resuming) replaces the previous file
+        stageVolume(self.volFn, outFn)
+        self.assertTrue(np.allclose(readMap(outFn), self.data))
+
+    def testStageConvertsStackItem(self):
+        # an indexed location may be one volume of a stack, never linked
+        outFn = self._tmp('volume2.map')
+        stageVolume((1, self.volFn), outFn)
+        self.assertFalse(os.path.islink(outFn))
+        self.assertTrue(np.allclose(readMap(outFn), self.data))
+
+    def testCheckHeaders(self):
+        otherFn = self._tmp('other.mrc')
+        writeMap(np.zeros((12, 12, 10), dtype=np.float32), otherFn)
+        self.assertEqual(checkVolumeHeaders([self.volFn, self.volFn]),
+                         (12, 12, 12))
+        with self.assertRaises(ValueError):
+            checkVolumeHeaders([self.volFn, otherFn])
+
+        sampledFn = self._tmp('sampled.mrc')
+        writeMap(self.data, sampledFn, 2.0)
+        mismatches = getSamplingMismatches([self.volFn, sampledFn], 1.5)
+        self.assertEqual([fn for fn, _ in mismatches], [sampledFn])
+
+    def testOpenBigEndian(self):
+        # same map written by a big-endian machine
+        raw = np.fromfile(self.volFn, dtype='u1')
+        swapped = raw.view('<u4').byteswap().view('u1').copy()
+        swapped[212:216] = [0x11, 0x11, 0, 0]
+        bigFn = self._tmp('big.mrc')
+        swapped.tofile(bigFn)
+        self.assertTrue(np.array_equal(openMap(bigFn), self.data))
+
+    def testCreateMap(self):
+        outFn = self._tmp('created.mrc')
+        volume = createMap(outFn, self.data.shape, 1.5)
+        volume[:] = self.data
+        volume.flush()
+        del volume
+        self.assertTrue(np.array_equal(readMap(outFn), self.data))
+        self.assertEqual(checkVolumeHeaders([self.volFn, outFn]),
+                         (12, 12, 12))
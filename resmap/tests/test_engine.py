@@ -0,0 +1,188 @@
+# **************************************************************************
+# *
+# * Authors:    Scipion Team (scipion@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import os
+import tempfile
+
+import numpy as np
+from pyworkflow.tests import BaseTest
+from scipy.ndimage import gaussian_filter
+
+from resmap.constants import (RESMAP_BACKGROUND, PRECISION_DOUBLE,
+                              PRECISION_SINGLE)
+from resmap.cache import SpectralCache
+from resmap.convert import readMap, writeMap
+from resmap.engine import (ResolutionEngine, fdrThreshold, estimateFiles,
+                           sweepFiles, getAnisotropy, DIRECTIONS)
+from resmap.phantoms import makePhantom
+from resmap.validation import precisionReport, measure
+
+
+class TestEngine(BaseTest):
+    @classmethod
+    def setUpClass(cls):
+        cls.half1, cls.half2, cls.mask = makePhantom(48, 1.0, 3.0, 8.0)
+
+    def testPhantomResolution(self):
+        engine = ResolutionEngine(1.0, 2.5, 10, 0.5)
+        resMap = engine.estimate(self.half1, self.half2, self.mask, 0.05)
+        self.assertTrue(np.all(resMap[~self.mask] == RESMAP_BACKGROUND))
+
+        z, y, x = np.ogrid[:48, :48, :48]
+        radius = np.sqrt((z - 23.5) ** 2 + (y - 23.5) ** 2 +
+                         (x - 23.5) ** 2) / 24
+        inner = np.median(resMap[radius < 0.3])
+        outer = np.median(resMap[(radius > 0.5) & self.mask])
+        self.assertLess(inner, outer)
+
+    def testFdrThreshold(self):
+        pValues = np.array([0.001, 0.2, 0.01, 0.04, 0.9])
+        self.assertEqual(fdrThreshold(pValues, 0.05), 0.01)
+        self.assertEqual(fdrThreshold(np.array([0.5, 0.9]), 0.05), -1)
+
+    def testSinglePrecision(self):
+        row = precisionReport(sizes=(48,))[0]
+        self.assertGreater(row['agreement'], 0.99)
+        self.assertLess(row['memorySingle'], 0.75 * row['memoryDouble'])
+
+        engine = ResolutionEngine(1.0, precision=PRECISION_SINGLE)
+        signal, noise = engine.whiten(self.half1, self.half2)
+        self.assertEqual(signal.dtype, np.complex64)
+        engine.setPrecision(PRECISION_DOUBLE)
+        signal, noise = engine.whiten(self.half1, self.half2)
+        self.assertEqual(signal.dtype, np.complex128)
+
+    def testSweep(self):
+        engine = ResolutionEngine(1.0, 2.5, 10, 0.5)
+        spectra = engine.whiten(self.half1, self.half2)
+        shape = self.half1.shape
+        single, _, singlePeak = measure(engine.estimate, None, None,
+                                        self.mask, 0.05, spectra, shape)
+        pVals = [0.05, 0.01, 0.001, 0.1]
+        resMaps, _, sweepPeak = measure(engine.estimateSweep, None, None,
+                                        self.mask, pVals, spectra, shape)
+        self.assertTrue(np.array_equal(resMaps[0.05], single))
+        # the p-values of all resolutions are never kept together
+        self.assertLess(sweepPeak, 1.25 * singlePeak)
+
+
+    def testAnisotropy(self):
+        engine = ResolutionEngine(1.0, 2.5, 10, 0.5)
+        # Every frequency belongs to some cone
+        shape = self.half1.shape
+        covered = np.zeros(engine._frequencies(shape).shape, dtype=bool)
+        for direction in DIRECTIONS:
+            covered |= engine.coneWeights(shape, direction)
+        self.assertTrue(covered.all())
+
+        # Blurring the signal along z worsens the resolution of the
+        # directions close to z
+        np.random.seed(1)
+        signal = gaussian_filter(np.random.standard_normal(shape),
+                                 (3.0, 0.6, 0.6)) * self.mask
+        signal /= signal[self.mask].std()
+        half1, half2 = [signal + 2 * np.random.standard_normal(shape)
+                        for i in range(2)]
+        resMaps = engine.estimateDirectional(half1, half2, self.mask)
+        medians = [np.median(m[self.mask]) for m in resMaps]
+        zAxis, xAxis = np.argmax(DIRECTIONS[:, 2]), np.argmax(DIRECTIONS[:, 0])
+        self.assertGreater(medians[zAxis], medians[xAxis])
+        anisotropy = getAnisotropy(resMaps)
+        self.assertTrue(np.all(anisotropy[self.mask] >= 1))
+        self.assertTrue(np.all(anisotropy[~self.mask] == RESMAP_BACKGROUND))
+
+
+class CountingEngine(ResolutionEngine):
+    kernelCalls = 0
+    whitenCalls = 0
+
+    def computeKernels(self, shape, resolution):
+        CountingEngine.kernelCalls += 1
+        return ResolutionEngine.computeKernels(self, shape, resolution)
+
+    def whiten(self, half1, half2):
+        CountingEngine.whitenCalls += 1
+        return ResolutionEngine.whiten(self, half1, half2)
+
+
+class TestSpectralCache(BaseTest):
+    @classmethod
+    def setUpClass(cls):
+        cls.tmpDir = tempfile.mkdtemp()
+        half1, half2, mask = makePhantom(32)
+        cls.files = [os.path.join(cls.tmpDir, fn)
+                     for fn in ('half1.mrc', 'half2.mrc')]
+        for data, fn in zip((half1, half2), cls.files):
+            writeMap(data, fn, 1.0)
+
+    def testCacheReuse(self):
+        cache = SpectralCache(os.path.join(self.tmpDir, 'cache'))
+        engine = CountingEngine(1.0, 2.5, 6, 0.5, cache=cache)
+        nres = len(engine.getResolutions())
+        for i in range(2):
+            spectra = cache.getSpectra(engine, *self.files)
+            engine.estimate(None, None, None, 0.05, spectra, (32, 32, 32))
+        self.assertEqual(CountingEngine.whitenCalls, 1)
+        self.assertEqual(CountingEngine.kernelCalls, nres)
+        # no temporary files are left behind
+        self.assertEqual(len(os.listdir(cache.path)), 2 + 2 * nres)
+
+        # A new process with an empty memory layer loads them from disk
+        engine.cache = SpectralCache(cache.path)
+        engine.estimate(None, None, None, 0.05,
+                        engine.cache.getSpectra(engine, *self.files),
+                        (32, 32, 32))
+        self.assertEqual(CountingEngine.whitenCalls, 1)
+        self.assertEqual(CountingEngine.kernelCalls, nres)
+
+    def testEstimateFiles(self):
+        params = {'samplingRate': 1.0, 'minRes': 2.5, 'maxRes': 6,
+                  'stepRes': 0.5, 'pVal': 0.05}
+        outFn = os.path.join(self.tmpDir, 'res.mrc')
+        outCachedFn = os.path.join(self.tmpDir, 'res_cached.mrc')
+        estimateFiles(self.files[0], self.files[1], outFn, None, params)
+        params['cachePath'] = os.path.join(self.tmpDir, 'cache2')
+        for i in range(2):
+            estimateFiles(self.files[0], self.files[1], outCachedFn, None,
+                          params)
+        self.assertTrue(np.array_equal(readMap(outFn), readMap(outCachedFn)))
+
+    def testSweepFiles(self):
+        params = {'samplingRate': 1.0, 'minRes': 2.5, 'maxRes': 6,
+                  'stepRes': 0.5}
+        outFns = {p: os.path.join(self.tmpDir, 'sweep_%g.mrc' % p)
+                  for p in (0.05, 0.001)}
+        results = sweepFiles(self.files[0], self.files[1], outFns, None,
+                             params)
+        for pVal, outFn in outFns.items():
+            singleFn = os.path.join(self.tmpDir, 'single_%g.mrc' % pVal)
+            stats = estimateFiles(self.files[0], self.files[1], singleFn,
+                                  None, dict(params, pVal=pVal))
+            self.assertTrue(np.array_equal(readMap(outFn),
+                                           readMap(singleFn)))
+            self.assertEqual(results[pVal], stats)
+        # A stricter test can not give a better resolution
+        self.assertGreaterEqual(results[0.001][1], results[0.05][1])
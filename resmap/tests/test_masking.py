@@ -0,0 +1,65 @@
+# **************************************************************************
+# *
+# * Authors:    Scipion Team (scipion@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import os
+import tempfile
+
+import numpy as np
+from pyworkflow.tests import BaseTest
+
+from resmap.convert import readMap, writeMap
+from resmap.masking import estimateMask, getCachedMask
+from resmap.phantoms import makePhantom
+
+
+class TestAutoMask(BaseTest):
+    @classmethod
+    def setUpClass(cls):
+        cls.half1, cls.half2, cls.mask = makePhantom(48)
+
+    def testEstimateMask(self):
+        mask = estimateMask(self.half1, self.half2, 1.0)
+        # the particle is covered and most of the solvent is excluded
+        self.assertGreater(np.mean(mask[self.mask]), 0.99)
+        self.assertLess(mask.sum(), 2 * self.mask.sum())
+
+    def testCachedMask(self):
+        tmpDir = tempfile.mkdtemp()
+        files = [os.path.join(tmpDir, fn) for fn in ('h1.mrc', 'h2.mrc')]
+        writeMap(self.half1, files[0], 1.0)
+        writeMap(self.half2, files[1], 1.0)
+        cachePath = os.path.join(tmpDir, 'cache')
+
+        mask1 = os.path.join(tmpDir, 'mask1.mrc')
+        mask2 = os.path.join(tmpDir, 'mask2.mrc')
+        self.assertFalse(getCachedMask(files[0], files[1], mask1, 1.0,
+                                       cachePath))
+        self.assertTrue(getCachedMask(files[0], files[1], mask2, 1.0,
+                                      cachePath))
+        self.assertTrue(np.array_equal(readMap(mask1), readMap(mask2)))
+        # different parameters do not hit the cached mask
+        self.assertFalse(getCachedMask(files[0], files[1], mask2, 1.0,
+                                       cachePath, dilation=1))
@@ -0,0 +1,87 @@
+# **************************************************************************
+# *
+# * Authors:    Scipion Team (scipion@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import os
+import tempfile
+
+import numpy as np
+from pyworkflow.tests import BaseTest
+
+from resmap.regions import RegionIndex
+
+
+class TestRegionIndex(BaseTest):
+    @classmethod
+    def setUpClass(cls):
+        np.random.seed(0)
+        cls.data = np.random.uniform(3, 12, (37, 30, 41)).astype(np.float32)
+        cls.data[:, :, :10] = 100
+        cls.index = RegionIndex.build(cls.data, 100, blockSize=4, nbins=200)
+
+    def _check(self, stats, values):
+        self.assertEqual(stats['count'], values.size)
+        self.assertAlmostEqual(stats['mean'], values.mean(), 4)
+        self.assertAlmostEqual(stats['min'], values.min(), 5)
+        self.assertAlmostEqual(stats['max'], values.max(), 5)
+        # median from the histogram is accurate to the bin width
+        binWidth = np.diff(stats['edges'])[0]
+        self.assertLess(abs(stats['median'] - np.median(values)), binWidth)
+
+    def testFullQuery(self):
+        self.assertEqual(self.index.levels[-1]['count'].size, 1)
+        self._check(self.index.query(), self.data[self.data < 100])
+
+    def testBoxQuery(self):
+        start, stop = (3, 5, 7), (30, 22, 33)
+        box = self.data[3:30, 5:22, 7:33]
+        stats = self.index.query(start, stop, data=self.data)
+        self._check(stats, box[box < 100])
+
+        fraction = self.index.fractionBelow(stats['hist'], 4.0)
+        expected = np.mean(box[box < 100] < 4.0)
+        self.assertLess(abs(fraction - expected), 0.01)
+
+        self.assertTrue(stats['exact'])
+
+        approx = self.index.query(start, stop)
+        self.assertLess(abs(approx['count'] / np.sum(box < 100) - 1), 0.1)
+        self.assertFalse(approx['exact'])
+        self.assertTrue(np.isnan(approx['min']) and np.isnan(approx['max']))
+
+    def testRebin(self):
+        values = self.data[self.data < 100]
+        hist, edges = self.index.rebin(self.index.query()['hist'], 40)
+        expected, _ = np.histogram(values, 40, (values.min(), values.max()))
+        self.assertTrue(np.allclose(hist, expected))
+
+    def testSaveLoad(self):
+        fn = os.path.join(tempfile.mkdtemp(), 'index.npz')
+        self.index.save(fn)
+        index = RegionIndex.load(fn)
+        self.assertEqual(index.shape, self.data.shape)
+        self.assertEqual(len(index.levels), len(self.index.levels))
+        self.assertTrue(np.allclose(index.overview(1),
+                                    self.index.overview(1), equal_nan=True))
@@ -0,0 +1,85 @@
+# **************************************************************************
+# *
+# * Authors:    Scipion Team (scipion@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import os
+import tempfile
+
+import numpy as np
+from pyworkflow.tests import BaseTest
+
+from resmap.regions import RegionIndex
+from resmap.store import ResultsStore, getIndexStats
+
+
+class TestResultsStore(BaseTest):
+    @classmethod
+    def setUpClass(cls):
+        np.random.seed(0)
+        cls.data = np.random.uniform(3, 12, (20, 20, 20)).astype(np.float32)
+        cls.data[:5] = 100
+        cls.stats = getIndexStats(RegionIndex.build(cls.data, 100))
+
+    def testIndexStats(self):
+        values = self.data[self.data < 100]
+        self.assertEqual(self.stats['voxels'], values.size)
+        self.assertAlmostEqual(self.stats['mean'], values.mean(), 4)
+        binWidth = np.diff(self.stats['edges'])[0]
+        self.assertLess(abs(self.stats['p25'] - np.percentile(values, 25)),
+                        binWidth)
+        self.assertLess(self.stats['p25'], self.stats['median'])
+
+    def testRuns(self):
+        store = ResultsStore(os.path.join(tempfile.mkdtemp(), 'runs.sqlite'))
+        for runId in range(5):
+            record = dict(self.stats, project='p1', runId=runId,
+                          runName='run %d' % runId, timestamp=runId,
+                          params={'pVal': 0.05})
+            record['median'] = 4 + runId
+            store.addRun(record)
+        store.addRun(dict(self.stats, project='p2', runId=0, timestamp=10))
+        # Rerunning a protocol replaces its row
+        store.addRun(dict(self.stats, project='p1', runId=4, median=3,
+                          timestamp=4))
+
+        rows = store.query(['runId', 'median', 'params'], project='p1')
+        self.assertEqual([r['runId'] for r in rows], [0, 1, 2, 3, 4])
+        self.assertEqual(rows[0]['params'], {'pVal': 0.05})
+        self.assertEqual(rows[-1]['median'], 3)
+        self.assertEqual(len(store.query(since=2, until=4)), 3)
+        self.assertEqual([r['runId'] for r in
+                          store.query(['runId'], project='p1', limit=2)],
+                         [3, 4])
+
+        times, medians = store.getTrend('median', project='p1')
+        self.assertTrue(np.array_equal(medians, [4, 5, 6, 7, 3]))
+
+        hist, edges = store.getHistogram('p1', 0)
+        self.assertTrue(np.array_equal(hist, self.stats['hist']))
+        self.assertTrue(np.array_equal(edges, self.stats['edges']))
+        self.assertIsNone(store.getHistogram('p3', 0))
+
+        with self.assertRaises(ValueError):
+            store.query(['runId; DROP TABLE runs'])
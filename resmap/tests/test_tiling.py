@@ -0,0 +1,95 @@
+# **************************************************************************
+# *
+# * Authors:    Scipion Team (scipion@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import numpy as np
+from pyworkflow.tests import BaseTest
+
+from resmap.tiling import (planTiles, cropTile, stitchTiles, LocalExecutor,
+                           roiMask, planRegion)
+
+
+def _tileMean(data, tile):
+    """ Fake per-tile estimation: constant map with the tile mean. """
+    return np.full(data.shape, data[tile.getInnerCore()].mean())
+
+
+class TestTiling(BaseTest):
+    def testPlanTiles(self):
+        shape = (30, 30, 30)
+        tiles = planTiles(shape, 3, 4)
+        self.assertEqual(len(tiles), 27)
+
+        coverage = np.zeros(shape, dtype=int)
+        for tile in tiles:
+            coverage[tile.getCore()] += 1
+            # cubic inputs give cubic tiles with the margin
+            self.assertEqual(tile.getShape(), (18, 18, 18))
+        self.assertTrue(np.all(coverage == 1))
+
+    def testStitchRoundTrip(self):
+        data = np.random.rand(25, 20, 16).astype(np.float32)
+        tiles = planTiles(data.shape, 2, 3)
+        results = [cropTile(data, tile) for tile in tiles]
+        stitched = stitchTiles(data.shape, tiles, results, 100)
+        self.assertTrue(np.array_equal(stitched, data))
+
+        results[0] = None
+        stitched = stitchTiles(data.shape, tiles, results, 100)
+        self.assertTrue(np.all(stitched[tiles[0].getCore()] == 100))
+
+    def testLocalExecutor(self):
+        data = np.random.rand(16, 16, 16)
+        tiles = planTiles(data.shape, 2, 2)
+        units = [(cropTile(data, tile), tile) for tile in tiles]
+        serial = LocalExecutor(1).run(_tileMean, units)
+        parallel = LocalExecutor(3).run(_tileMean, units)
+        for a, b in zip(serial, parallel):
+            self.assertTrue(np.allclose(a, b))
+
+        stitched = stitchTiles(data.shape, tiles, parallel, 100)
+        for tile in tiles:
+            self.assertAlmostEqual(float(stitched[tile.getCore()].mean()),
+                                   float(data[tile.getCore()].mean()), 5)
+
+    def testRegionOfInterest(self):
+        shape = (64, 64, 64)
+        sphere = roiMask(shape, (40, 20, 30), radius=6)
+        self.assertEqual(int(sphere[30, 20, 40]), 1)
+        self.assertEqual(int(sphere[30, 20, 47]), 0)
+
+        region = planRegion(sphere, 5)
+        # the processed region only covers the ROI plus the margin
+        self.assertEqual(region.getShape(), (23, 23, 23))
+        self.assertEqual(int(sphere[region.getCore()].sum()), int(sphere.sum()))
+
+        data = np.random.rand(*shape).astype(np.float32)
+        result = stitchTiles(shape, [region], [cropTile(data, region)], 100)
+        self.assertTrue(np.array_equal(result[sphere], data[sphere]))
+
+        box = roiMask(shape, (5, 5, 5), size=8)
+        region = planRegion(box, 10)
+        self.assertEqual(region.start, (0, 0, 0))
+        self.assertEqual(region.getShape(), (27, 27, 27))
@@ -0,0 +1,67 @@
+# **************************************************************************
+# *
+# * Authors:    Scipion Team (scipion@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import os
+import tempfile
+
+from pyworkflow.tests import BaseTest
+
+from resmap.validation import compareModes, isBinaryAvailable, readReport
+
+
+class TestRegression(BaseTest):
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        self.historyFn = os.path.join(self.tmpDir, 'history.tsv')
+
+    def testTiledEngine(self):
+        for i in range(2):
+            row = compareModes('double', 'tiled', sizes=(48,), maxRes=5,
+                               workDir=self.tmpDir,
+                               historyFn=self.historyFn)[0]
+        self.assertGreater(row['voxels'], 0)
+        # Tiles whiten and control the FDR locally, so only the
+        # distribution is expected to match
+        self.assertGreater(row['agreement'], 0.8)
+        self.assertLess(abs(row['logMedianShift']), 0.5)
+        self.assertGreater(row['timeB'], 0)
+        self.assertGreater(row['memoryA'], 0)
+
+        history = readReport(self.historyFn)
+        self.assertEqual(len(history), 2)
+        self.assertEqual(history[1]['modeB'], 'tiled')
+        self.assertEqual(float(history[1]['medianA']), row['medianA'])
+
+    def testUnknownMode(self):
+        with self.assertRaises(ValueError):
+            compareModes('double', 'quantum')
+
+    def testBinary(self):
+        if not isBinaryAvailable():
+            self.skipTest('ResMap binary not installed')
+        row = compareModes('binary', 'double', sizes=(64,),
+                           workDir=self.tmpDir)[0]
+        self.assertGreater(row['voxels'], 0)
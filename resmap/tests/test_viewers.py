@@ -0,0 +1,65 @@
+# **************************************************************************
+# *
+# * Authors:    Scipion Team (scipion@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import os
+import tempfile
+
+import numpy as np
+from pyworkflow.tests import BaseTest
+
+from resmap.constants import RESMAP_BACKGROUND
+from resmap.convert import writeMap
+from resmap.viewers.background import Task
+from resmap.viewers.resmap_viewers import ResMapViewer, READ_CHUNK
+
+
+class FakeProtocol:
+    def __init__(self, resMapFn):
+        self.resMapFn = resMapFn
+
+    def _getFileName(self, key):
+        return self.resMapFn
+
+
+class TestViewerLoading(BaseTest):
+    def testLoadImgData(self):
+        np.random.seed(0)
+        data = np.random.uniform(2, 4, (READ_CHUNK + 4, 20, 20))
+        data[:, :5] = RESMAP_BACKGROUND
+        resMapFn = os.path.join(tempfile.mkdtemp(), 'resmap.map')
+        writeMap(data, resMapFn, 1.0)
+
+        viewer = ResMapViewer.__new__(ResMapViewer)
+        viewer.protocol = FakeProtocol(resMapFn)
+        imgData, minRes, maxRes, dims = viewer._loadImgData(Task('load'))
+        expected = viewer.getImgData(resMapFn)
+        # the background is hidden, as when reading the map at once
+        self.assertTrue(np.all(imgData.mask == expected[0].mask))
+        self.assertTrue(np.all(imgData.mask[:, :5]))
+        self.assertAlmostEqual(maxRes, expected[2], 5)
+        self.assertLess(maxRes, 4)
+        self.assertAlmostEqual(minRes, expected[1], 5)
+        self.assertEqual(tuple(dims), tuple(expected[3]))
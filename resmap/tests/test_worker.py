@@ -0,0 +1,119 @@
+# **************************************************************************
+# *
+# * Authors:    Scipion Team (scipion@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import os
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from pyworkflow.tests import BaseTest
+
+from resmap.convert import readMap, writeMap
+from resmap.engine import estimateFiles
+from resmap.phantoms import makePhantom
+from resmap.worker import (EstimationWorker, WorkerClient, startWorker,
+                           checkPrivateFolder)
+
+
+class TestWorker(BaseTest):
+    @classmethod
+    def setUpClass(cls):
+        cls.tmpDir = tempfile.mkdtemp()
+        half1, half2, mask = makePhantom(32)
+        cls.files = [os.path.join(cls.tmpDir, fn)
+                     for fn in ('half1.mrc', 'half2.mrc')]
+        for data, fn in zip((half1, half2), cls.files):
+            writeMap(data, fn, 1.0)
+        cls.params = {'samplingRate': 1.0, 'minRes': 2.5, 'maxRes': 6,
+                      'stepRes': 0.5, 'pVal': 0.05,
+                      'cachePath': os.path.join(cls.tmpDir, 'cache')}
+
+    def startWorker(self, name, idleTimeout=60):
+        address = os.path.join(self.tmpDir, name)
+        worker = EstimationWorker(address, idleTimeout)
+        thread = threading.Thread(target=worker.serve, daemon=True)
+        thread.start()
+        client = WorkerClient(address)
+        for i in range(50):
+            if client.ping() is not None:
+                break
+            thread.join(0.1)
+        return worker, thread, client
+
+    def testJobs(self):
+        worker, thread, client = self.startWorker('jobs.sock')
+        self.assertEqual(client.ping()['jobs'], 0)
+
+        outFn = os.path.join(self.tmpDir, 'worker.mrc')
+        localFn = os.path.join(self.tmpDir, 'local.mrc')
+        for i in range(2):
+            result = client.estimate(self.files[0], self.files[1], outFn,
+                                     None, self.params)
+        self.assertEqual(result, estimateFiles(self.files[0], self.files[1],
+                                               localFn, None, self.params))
+        self.assertTrue(np.array_equal(readMap(outFn), readMap(localFn)))
+        # Kernels stay in memory between jobs
+        self.assertEqual(len(worker._caches), 1)
+
+        with self.assertRaises(RuntimeError):
+            client.estimate('missing.mrc', 'missing.mrc', outFn, None,
+                            self.params)
+        self.assertEqual(client.ping()['jobs'], 3)
+
+        client.shutdown()
+        thread.join(10)
+        self.assertFalse(thread.is_alive())
+        self.assertIsNone(client.ping())
+        self.assertFalse(os.path.exists(client.address))
+
+    def testIdleTimeout(self):
+        worker, thread, client = self.startWorker('idle.sock', idleTimeout=1)
+        self.assertIsNotNone(client.ping())
+        thread.join(10)
+        self.assertFalse(thread.is_alive())
+        self.assertIsNone(client.ping())
+
+    def testConcurrentStart(self):
+        # parallel runs share the worker started by the first one
+        address = os.path.join(self.tmpDir, 'shared.sock')
+        with ThreadPoolExecutor(4) as executor:
+            clients = list(executor.map(lambda i: startWorker(address, 60),
+                                        range(4)))
+        pids = {client.ping()['pid'] for client in clients}
+        self.assertEqual(len(pids), 1)
+        self.assertNotEqual(pids.pop(), os.getpid())
+        clients[0].shutdown()
+
+    def testPrivateFolder(self):
+        folder = os.path.join(self.tmpDir, 'shared')
+        os.makedirs(folder, mode=0o755)
+        os.chmod(folder, 0o755)
+        with self.assertRaises(PermissionError):
+            checkPrivateFolder(folder)
+        checkPrivateFolder(os.path.join(self.tmpDir, 'private'))
+        self.assertEqual(os.stat(os.path.join(self.tmpDir, 'private'))
+                         .st_mode & 0o777, 0o700)
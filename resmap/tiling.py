@@ -0,0 +1,180 @@
+# **************************************************************************
+# *
+# * Authors:    Scipion Team (scipion@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Split a volume in tiles that can be processed as independent work units
+and stitch the partial results back into a full-size map.
+
+Each tile has a core region, which is the part of the output it is
+responsible for, and a larger region (core plus a margin) that is
+actually processed, so the local test window of the voxels close to the
+core border is fully contained in the tile.
+"""
+
+import multiprocessing
+
+import numpy as np
+from pyworkflow.utils import runJob
+
+
+class Tile:
+    """ Work unit covering a sub-box of the volume. """
+    def __init__(self, index, start, stop, coreStart, coreStop):
+        self.index = index
+        self.start = tuple(start)  # processed region, with margin
+        self.stop = tuple(stop)
+        self.coreStart = tuple(coreStart)  # region written to the output
+        self.coreStop = tuple(coreStop)
+
+    def getRegion(self):
+        """ Slices of the processed region in the full volume. """
+        return tuple(slice(a, b) for a, b in zip(self.start, self.stop))
+
+    def getCore(self):
+        """ Slices of the core region in the full volume. """
+        return tuple(slice(a, b) for a, b in zip(self.coreStart,
+                                                  self.coreStop))
+
+    def getInnerCore(self):
+        """ Slices of the core region inside the tile array. """
+        return tuple(slice(a - s, b - s) for a, b, s in zip(self.coreStart,
+                                                             self.coreStop,
+                                                             self.start))
+
+    def getShape(self):
+        return tuple(b - a for a, b in zip(self.start, self.stop))
+
+    def __repr__(self):
+        return 'Tile(%d, core=%s-%s)' % (self.index, self.coreStart,
+                                         self.coreStop)
+
+
+def _splitAxis(dim, parts, margin):
+    """ Return (start, stop, coreStart, coreStop) along one axis.
+    All processed regions have the same length, shifted inwards at the
+    volume borders, so cubic volumes produce cubic tiles.
+    """
+    parts = max(1, min(parts, dim))
+    bounds = np.linspace(0, dim, parts + 1).round().astype(int)
+    coreLen = int(np.max(np.diff(bounds)))
+    length = min(dim, coreLen + 2 * margin)
+    result = []
+    for coreStart, coreStop in zip(bounds[:-1], bounds[1:]):
+        start = int(np.clip(coreStart - margin, 0, dim - length))
+        result.append((start, start + length, int(coreStart), int(coreStop)))
+    return result
+
+
+def planTiles(shape, tilesPerAxis, margin):
+    """ Split a volume of the given shape (z, y, x) in
+    tilesPerAxis^3 tiles with the given margin (in voxels).
+    """
+    axes = [_splitAxis(dim, tilesPerAxis, margin) for dim in shape]
+    tiles = []
+    for z in axes[0]:
+        for y in axes[1]:
+            for x in axes[2]:
+                parts = list(zip(z, y, x))
+                tiles.append(Tile(len(tiles), *parts))
+    return tiles
+
+
+def roiMask(shape, center, size=None, radius=None):
+    """ Boolean mask (z, y, x) of a cubic box of the given size or a
+    sphere of the given radius around center (x, y, z), in voxels.
+    """
+    z, y, x = np.ogrid[:shape[0], :shape[1], :shape[2]]
+    cx, cy, cz = center
+    if radius is not None:
+        return (x - cx) ** 2 + (y - cy) ** 2 + (z - cz) ** 2 <= radius ** 2
+
+    half = size / 2.0
+    return ((np.abs(x - cx) < half) & (np.abs(y - cy) < half) &
+            (np.abs(z - cz) < half))
+
+
+def planRegion(mask, margin):
+    """ Return a Tile whose core is the bounding box of the mask and
+    whose processed region adds the margin. The region has the same
+    length on all axes when the volume allows it.
+    """
+    coords = np.nonzero(mask)
+    if not coords[0].size:
+        raise ValueError("The region of interest is empty.")
+    coreStart = [int(c.min()) for c in coords]
+    coreStop = [int(c.max()) + 1 for c in coords]
+    length = max(b - a for a, b in zip(coreStart, coreStop)) + 2 * margin
+
+    start, stop = [], []
+    for dim, a, b in zip(mask.shape, coreStart, coreStop):
+        axisLength = min(dim, length)
+        center = (a + b) // 2
+        axisStart = int(np.clip(center - axisLength // 2, 0,
+                                dim - axisLength))
+        start.append(axisStart)
+        stop.append(axisStart + axisLength)
+    return Tile(0, start, stop, coreStart, coreStop)
+
+
+def cropTile(data, tile):
+    """ Return a copy of the processed region of the tile. """
+    return np.array(data[tile.getRegion()])
+
+
+def stitchTiles(shape, tiles, results, background, dtype=np.float32):
+    """ Compose the full-size map from the tile results.
+    Tiles without result (None) are left with the background value.
+    """
+    output = np.full(shape, background, dtype=dtype)
+    for tile, result in zip(tiles, results):
+        if result is not None:
+            output[tile.getCore()] = result[tile.getInnerCore()]
+    return output
+
+
+def runTileJob(program, args, cwd, env=None):
+    """ Run the estimation program for one tile.
+    Defined at module level so it can be sent to worker processes.
+    """
+    runJob(None, program, args, env=env, cwd=cwd)
+    return cwd
+
+
+class LocalExecutor:
+    """ Run work units in a pool of local processes.
+    It provides the same contract as submitting each unit as a separate
+    job: units are independent and results are returned in order.
+    """
+    def __init__(self, workers=1):
+        self.workers = max(1, int(workers))
+
+    def run(self, func, units):
+        """ Call func(*unit) for each unit and return the list of results. """
+        units = list(units)
+        if self.workers == 1 or len(units) < 2:
+            return [func(*unit) for unit in units]
+
+        with multiprocessing.Pool(min(self.workers, len(units))) as pool:
+            return pool.starmap(func, units)
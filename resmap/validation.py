@@ -0,0 +1,349 @@
+# **************************************************************************
+# *
+# * Authors:    Scipion Team (scipion@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Compare resolution maps obtained with different execution settings.
+
+The regression harness runs two execution modes (see EXECUTION_MODES)
+on the same synthetic phantoms, compares their resolution maps inside
+the particle mask and appends the results, with the runtime and memory
+of each mode, to a history file. The ResMap binary is only used if it
+is installed.
+
+Usage: python -m resmap.validation MODE_A MODE_B [--sizes 64 96]
+                                   [--history FILE] [--workDir DIR]
+"""
+
+import argparse
+import json
+import math
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+import resmap
+from resmap.constants import (RESMAP_BACKGROUND, PRECISION_DOUBLE,
+                              PRECISION_SINGLE)
+from resmap.convert import (readMap, writeMap, writeResMapLog,
+                            parseResMapLog, getResolutionStats)
+from resmap.engine import ResolutionEngine, estimateFiles
+from resmap.phantoms import makePhantom
+from resmap.tiling import planTiles, cropTile, stitchTiles
+
+
+def measure(func, *args, **kwargs):
+    """ Call func and return (result, seconds, peak allocated bytes). """
+    tracemalloc.start()
+    try:
+        t0 = time.time()
+        result = func(*args, **kwargs)
+        elapsed = time.time() - t0
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return result, elapsed, peak
+
+
+def compareMaps(resA, resB, mask=None, tolerance=0.0):
+    """ Voxel-wise comparison of two resolution maps inside the mask
+    (by default, voxels below the background in both maps).
+    """
+    if mask is None:
+        mask = (resA < RESMAP_BACKGROUND) & (resB < RESMAP_BACKGROUND)
+    a = resA[mask].astype(np.float64)
+    b = resB[mask].astype(np.float64)
+    if not a.size:
+        return {'voxels': 0, 'agreement': np.nan, 'maxDeviation': np.nan,
+                'meanShift': np.nan, 'medianShift': np.nan}
+
+    diff = np.abs(a - b)
+    return {'voxels': int(a.size),
+            'agreement': float(np.mean(diff <= tolerance + 1e-6)),
+            'maxDeviation': float(diff.max()),
+            'meanShift': float(b.mean() - a.mean()),
+            'medianShift': float(np.median(b) - np.median(a))}
+
+
+def precisionReport(sizes=(64, 96), samplingRate=1.0, minRes=2.5,
+                    maxRes=10, stepRes=0.5, pVal=0.05):
+    """ Run the engine in double and single precision on synthetic
+    phantoms and return one row per phantom with the differences in the
+    resolution map, runtime and peak memory of both modes.
+    """
+    rows = []
+    for size in sizes:
+        half1, half2, mask = makePhantom(size, samplingRate)
+        results = {}
+        for precision in (PRECISION_DOUBLE, PRECISION_SINGLE):
+            engine = ResolutionEngine(samplingRate, minRes, maxRes, stepRes,
+                                      precision=precision)
+            results[precision] = measure(engine.estimate, half1, half2,
+                                         mask, pVal)
+        (resDouble, timeDouble, memDouble) = results[PRECISION_DOUBLE]
+        (resSingle, timeSingle, memSingle) = results[PRECISION_SINGLE]
+        row = {'size': size,
+               'timeDouble': timeDouble, 'timeSingle': timeSingle,
+               'memoryDouble': memDouble, 'memorySingle': memSingle}
+        row.update(compareMaps(resDouble, resSingle, mask))
+        rows.append(row)
+    return rows
+
+
+def writeReport(rows, fileName):
+    """ Write report rows as a tab separated table. """
+    if not rows:
+        return
+    keys = list(rows[0].keys())
+    with open(fileName, 'w') as f:
+        f.write('\t'.join(keys) + '\n')
+        for row in rows:
+            f.write('\t'.join(str(row[k]) for k in keys) + '\n')
+
+
+def appendReport(rows, fileName):
+    """ Append report rows to a tab separated history file, writing the
+    header if the file is new. Rows are written in the columns of the
+    existing header.
+    """
+    if not rows:
+        return
+    if not os.path.exists(fileName):
+        writeReport(rows, fileName)
+        return
+    with open(fileName) as f:
+        keys = f.readline().rstrip('\n').split('\t')
+    with open(fileName, 'a') as f:
+        for row in rows:
+            f.write('\t'.join(str(row.get(k, '')) for k in keys) + '\n')
+
+
+def readReport(fileName):
+    """ Read the rows (dicts of strings) of a report or history file. """
+    with open(fileName) as f:
+        keys = f.readline().rstrip('\n').split('\t')
+        return [dict(zip(keys, line.rstrip('\n').split('\t')))
+                for line in f if line.strip()]
+
+
+# ------------------------------ Execution modes ------------------------------
+# Each mode runs in a folder containing volume1.map, volume2.map and
+# mask.map, with a dict of parameters (samplingRate, minRes, maxRes,
+# stepRes, pVal), and returns the resolution map, the log file and the
+# peak resident memory in bytes of the process running it, or None when
+# it runs in the calling process.
+
+# Run an in-process mode in a new Python process (see _runModeProcess)
+_MODE_PROCESS_CODE = ('import json, sys; '
+                      'from resmap.validation import EXECUTION_MODES; '
+                      'EXECUTION_MODES[sys.argv[1]](sys.argv[2], '
+                      'json.loads(sys.argv[3]))')
+
+def isBinaryAvailable():
+    try:
+        return os.path.exists(resmap.Plugin.getProgram())
+    except TypeError:
+        return False  # plugin variables not defined, outside Scipion
+
+
+def _waitProcess(process):
+    """ Wait for a child process and return its peak resident memory in
+    bytes. Raise CalledProcessError if it failed.
+    """
+    # wait4 returns the resource usage of this child only
+    _, status, usage = os.wait4(process.pid, 0)
+    process.returncode = (os.WEXITSTATUS(status) if os.WIFEXITED(status)
+                          else -os.WTERMSIG(status))
+    if process.returncode:
+        raise subprocess.CalledProcessError(process.returncode, process.args)
+    return usage.ru_maxrss * 1024
+
+
+def _runBinary(workDir, params):
+    """ Run the ResMap binary as estimateResolutionStep does. """
+    if not isBinaryAvailable():
+        raise ValueError("ResMap binary not found: %s"
+                         % resmap.Plugin.getProgram())
+    args = [resmap.Plugin.getProgram(), '--noguiSplit', 'volume1.map',
+            'volume2.map', '--vxSize=%0.3f' % params['samplingRate'],
+            '--pVal=%f' % params['pVal'], '--maxRes=%f' % params['maxRes'],
+            '--minRes=%f' % params['minRes'],
+            '--stepRes=%f' % params['stepRes'], '--maskVol=mask.map']
+    stdoutFn = os.path.join(workDir, 'stdout.log')
+    with open(stdoutFn, 'w') as f:
+        peak = _waitProcess(subprocess.Popen(
+            args, cwd=workDir, stdout=f, stderr=subprocess.STDOUT,
+            env=dict(resmap.Plugin.getEnviron())))
+    logFn = os.path.join(workDir, 'ResMaps.log')
+    return (os.path.join(workDir, 'volume1_ori_resmap.map'),
+            logFn if os.path.exists(logFn) else stdoutFn, peak)
+
+
+def _getFiles(workDir):
+    return [os.path.join(workDir, fn) for fn in
+            ('volume1.map', 'volume2.map', 'volume1_ori_resmap.map',
+             'mask.map', 'ResMaps.log')]
+
+
+def _runEngine(workDir, params, precision):
+    half1Fn, half2Fn, outFn, maskFn, logFn = _getFiles(workDir)
+    estimateFiles(half1Fn, half2Fn, outFn, maskFn,
+                  dict(params, precision=precision, logFn=logFn))
+    return outFn, logFn, None
+
+
+def _runTiled(workDir, params, tilesPerAxis=2):
+    """ In-process engine on tiles with the margin used by the protocol. """
+    half1Fn, half2Fn, outFn, maskFn, logFn = _getFiles(workDir)
+    half1, half2 = readMap(half1Fn), readMap(half2Fn)
+    mask = readMap(maskFn) > 0
+    margin = int(math.ceil(2 * params['maxRes'] / params['samplingRate']))
+    tiles = planTiles(half1.shape, tilesPerAxis, margin)
+    engineParams = dict(params)
+    pVal = engineParams.pop('pVal')
+    engine = ResolutionEngine(**engineParams)
+    results = [engine.estimate(cropTile(half1, t), cropTile(half2, t),
+                               cropTile(mask, t), pVal)
+               if mask[t.getCore()].any() else None for t in tiles]
+    resData = stitchTiles(half1.shape, tiles, results, RESMAP_BACKGROUND)
+    writeMap(resData, outFn, params['samplingRate'])
+    writeResMapLog(logFn, *getResolutionStats(resData, RESMAP_BACKGROUND))
+    return outFn, logFn, None
+
+
+EXECUTION_MODES = {
+    'binary': _runBinary,
+    'double': lambda workDir, params: _runEngine(workDir, params,
+                                                 PRECISION_DOUBLE),
+    'single': lambda workDir, params: _runEngine(workDir, params,
+                                                 PRECISION_SINGLE),
+    'tiled': _runTiled
+}
+
+
+def _runModeProcess(mode, workDir, params):
+    """ Run an in-process mode in a new Python process, so its memory is
+    measured as the binary one: the peak resident size of the process,
+    including the interpreter and the imported modules.
+    """
+    workDir = os.path.abspath(workDir)
+    args = [sys.executable, '-c', _MODE_PROCESS_CODE, mode, workDir,
+            json.dumps(params)]
+    # importable also from a source tree
+    rootDir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    peak = _waitProcess(subprocess.Popen(args, cwd=rootDir))
+    _, _, resFn, _, logFn = _getFiles(workDir)
+    return resFn, logFn, peak
+
+
+def runMode(mode, workDir, params):
+    """ Run an execution mode and return (resolution map file, log file,
+    seconds, peak memory in bytes). Every mode runs in its own process
+    and its memory is the maximum resident size of that process, so the
+    values of all modes are comparable. Times include the process start.
+    """
+    if mode not in EXECUTION_MODES:
+        raise ValueError("Unknown execution mode %s, available: %s"
+                         % (mode, ', '.join(sorted(EXECUTION_MODES))))
+    t0 = time.time()
+    if mode == 'binary':
+        resFn, logFn, peak = _runBinary(workDir, params)
+    else:
+        resFn, logFn, peak = _runModeProcess(mode, workDir, params)
+    return resFn, logFn, time.time() - t0, peak
+
+
+def compareModes(modeA, modeB, sizes=(64,), samplingRate=1.0, minRes=2.5,
+                 maxRes=10, stepRes=0.5, pVal=0.05, tolerance=0.0,
+                 workDir=None, historyFn=None):
+    """ Run two execution modes on synthetic phantoms and return one row
+    per phantom with the voxel-wise comparison of the resolution maps
+    inside the phantom mask, the mean and median from the logs and the
+    runtime and memory of both modes. Rows are appended to historyFn if
+    given.
+    """
+    for mode in (modeA, modeB):
+        if mode not in EXECUTION_MODES:
+            raise ValueError("Unknown execution mode %s" % mode)
+    workDir = workDir or tempfile.mkdtemp(prefix='resmap_regression_')
+    params = {'samplingRate': samplingRate, 'minRes': minRes,
+              'maxRes': maxRes, 'stepRes': stepRes, 'pVal': pVal}
+    rows = []
+    for size in sizes:
+        half1, half2, mask = makePhantom(size, samplingRate)
+        row = {'timestamp': time.strftime('%Y-%m-%d %H:%M:%S'),
+               'version': resmap.__version__, 'size': size,
+               'modeA': modeA, 'modeB': modeB, 'tolerance': tolerance}
+        resMaps = []
+        for key, mode in (('A', modeA), ('B', modeB)):
+            modeDir = os.path.join(workDir, '%03d_%s' % (size, key))
+            os.makedirs(modeDir, exist_ok=True)
+            for data, fn in zip((half1, half2, mask.astype(np.float32)),
+                                ('volume1.map', 'volume2.map', 'mask.map')):
+                writeMap(data, os.path.join(modeDir, fn), samplingRate)
+            resFn, logFn, seconds, peak = runMode(mode, modeDir, params)
+            resMaps.append(readMap(resFn))
+            row['time' + key] = seconds
+            row['memory' + key] = peak
+            row['mean' + key], row['median' + key] = parseResMapLog(logFn)
+        row.update(compareMaps(resMaps[0], resMaps[1], mask, tolerance))
+        row['logMeanShift'] = row['meanB'] - row['meanA']
+        row['logMedianShift'] = row['medianB'] - row['medianA']
+        rows.append(row)
+
+    if historyFn:
+        appendReport(rows, historyFn)
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('modes', nargs=2, choices=sorted(EXECUTION_MODES),
+                        help='Execution modes to compare.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[64, 96],
+                        help='Box sizes of the phantoms.')
+    parser.add_argument('--tolerance', type=float, default=0.0,
+                        help='Resolution difference considered agreement.')
+    parser.add_argument('--history', default='resmap_regression.tsv',
+                        help='History file where the results are appended.')
+    parser.add_argument('--workDir', help='Folder for the runs.')
+    args = parser.parse_args()
+    if 'binary' in args.modes and not isBinaryAvailable():
+        parser.error('the ResMap binary is not installed.')
+
+    for row in compareModes(args.modes[0], args.modes[1], args.sizes,
+                            tolerance=args.tolerance, workDir=args.workDir,
+                            historyFn=args.history):
+        print('size %(size)d: agreement %(agreement)0.3f, max deviation '
+              '%(maxDeviation)0.2f A, median shift %(logMedianShift)0.2f A, '
+              'time %(timeA)0.2f s / %(timeB)0.2f s' % row)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,185 @@
+# **************************************************************************
+# *
+# * Authors:    Scipion Team (scipion@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Run viewer computations in a background thread and deliver the results
+in the Tk thread, so the GUI stays responsive while big maps are read.
+"""
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# Milliseconds between checks of the running tasks from the Tk thread
+POLL_INTERVAL = 100
+
+
+class TaskCancelled(Exception):
+    """ Raised inside a task when it has been cancelled. """
+    pass
+
+
+class Task:
+    """ Handle passed to the background functions to report progress
+    and check for cancellation.
+    """
+    def __init__(self, key):
+        self.key = key
+        self.future = None
+        self.callbacks = []  # (onDone, onError) of coalesced requests
+        self.progress = 0.0
+        self.message = ''
+        self._cancelled = threading.Event()
+
+    def setProgress(self, fraction, message=None):
+        """ Report progress (0 to 1) and raise TaskCancelled if the task
+        has been cancelled, so it is a natural cancellation point.
+        """
+        self.progress = float(fraction)
+        if message is not None:
+            self.message = message
+        self.checkCancelled()
+
+    def cancel(self):
+        self._cancelled.set()
+        if self.future is not None:
+            self.future.cancel()
+
+    def isCancelled(self):
+        return self._cancelled.is_set()
+
+    def checkCancelled(self):
+        if self.isCancelled():
+            raise TaskCancelled(self.key)
+
+
+class BackgroundTasks:
+    """ Executor of keyed tasks. Submitting a key that is already running
+    does not start a new computation: its callbacks are added to the
+    running one. Callbacks are called from deliver(), which is scheduled
+    in the Tk loop if a root is given.
+    """
+    def __init__(self, tkRoot=None, workers=1, onProgress=None):
+        self.tkRoot = tkRoot
+        self.onProgress = onProgress  # called with the running tasks
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._tasks = {}
+        self._polling = False
+
+    def submit(self, key, func, onDone, onError=None):
+        """ Run func(task) in the background and call onDone(result) or
+        onError(exception) when it finishes. Return the Task.
+        """
+        task = self._tasks.get(key)
+        if task is None or task.isCancelled():
+            task = Task(key)
+            task.future = self._executor.submit(func, task)
+            self._tasks[key] = task
+        task.callbacks.append((onDone, onError))
+        self._schedule()
+        return task
+
+    def cancel(self, key=None):
+        """ Cancel the task of the key, or all of them. Their callbacks
+        are not called.
+        """
+        keys = list(self._tasks) if key is None else [key]
+        for k in keys:
+            task = self._tasks.pop(k, None)
+            if task is not None:
+                task.cancel()
+
+    def getRunning(self):
+        return list(self._tasks.values())
+
+    def deliver(self):
+        """ Call the callbacks of the finished tasks. Must be called from
+        the Tk thread. Return True if some task is still running.
+        """
+        for key, task in list(self._tasks.items()):
+            if not task.future.done():
+                continue
+            del self._tasks[key]
+            if task.isCancelled() or task.future.cancelled():
+                continue
+            error = task.future.exception()
+            for onDone, onError in task.callbacks:
+                if error is None:
+                    onDone(task.future.result())
+                elif onError is not None:
+                    onError(error)
+        if self.onProgress is not None:
+            self.onProgress(self.getRunning())
+        return bool(self._tasks)
+
+    def wait(self, key):
+        """ Block until the task of the key finishes (for scripting). """
+        task = self._tasks.get(key)
+        if task is not None:
+            try:
+                task.future.result()
+            except Exception:
+                pass  # reported by deliver
+
+    def _poll(self):
+        self._polling = self.deliver()
+        if self._polling:
+            self.tkRoot.after(POLL_INTERVAL, self._poll)
+
+    def _schedule(self):
+        if self.tkRoot is not None and not self._polling:
+            self._polling = True
+            self.tkRoot.after(POLL_INTERVAL, self._poll)
+
+    def shutdown(self):
+        self.cancel()
+        self._executor.shutdown(wait=False)
+
+
+class ProgressWindow:
+    """ Small window showing the running tasks with a Cancel button. """
+    def __init__(self, tkRoot, onCancel):
+        import tkinter as tk
+        from tkinter import ttk
+        self.window = tk.Toplevel(tkRoot)
+        self.window.title('ResMap viewer')
+        self.window.protocol('WM_DELETE_WINDOW', onCancel)
+        self.label = tk.Label(self.window, width=40, anchor='w')
+        self.label.pack(padx=10, pady=(10, 5), fill='x')
+        self.bar = ttk.Progressbar(self.window, length=300, maximum=1.0)
+        self.bar.pack(padx=10, pady=5)
+        tk.Button(self.window, text='Cancel',
+                  command=onCancel).pack(pady=(5, 10))
+
+    def update(self, tasks):
+        """ Show the progress of the first running task. """
+        task = tasks[0]
+        text = task.message or str(task.key)
+        if len(tasks) > 1:
+            text += ' (+%d more)' % (len(tasks) - 1)
+        self.label.configure(text=text)
+        self.bar.configure(value=task.progress)
+
+    def close(self):
+        self.window.destroy()
@@ -25,10 +25,10 @@
 # **************************************************************************
 import os
 
+import numpy as np
 from matplotlib import cm
 
 from pwem.constants import COLOR_OTHER, AX_Z
-from pwem.emlib.image import ImageHandler
 from pwem.wizards import ColorScaleWizardBase
 from pyworkflow.protocol.params import LabelParam, EnumParam, \
     LEVEL_ADVANCED, IntParam
@@ -37,12 +37,21 @@ from pwem.viewers import (ChimeraView, LocalResolutionViewer, DataView,
                           EmPlotter)
 
 from resmap import RESMAP_VOL
+from resmap.constants import RESMAP_BACKGROUND
+from resmap.convert import openMap
 from resmap.protocols import ProtResMap
+from resmap.viewers.background import (BackgroundTasks, ProgressWindow,
+                                       Task)
 import matplotlib.pyplot as plt
 
 
 
 binaryCondition = ('(colorMap == %d) ' % COLOR_OTHER)
+# Slices read at once by the background loaders, between cancellation
+# checks
+READ_CHUNK = 16
+# Values above are hidden, they are the background written outside the mask
+MAX_MASK_VALUE = RESMAP_BACKGROUND - 0.1
 
 class ResMapViewer(LocalResolutionViewer):
     """Visualization tools for ResMap results. """
@@ -92,13 +101,128 @@ class ResMapViewer(LocalResolutionViewer):
                        label="Show Resolution map in Chimera")
 
         # get default values
-        imageFile = self.protocol._getFileName(RESMAP_VOL)
-        _, min_Res, max_Res, _ = self.getImgData(imageFile)
+        min_Res, max_Res = self._getResolutionRange()
 
         ColorScaleWizardBase.defineColorScaleParams(group, defaultLowest=min_Res, defaultHighest=max_Res)
 
+        group = form.addGroup('Project runs')
+        group.addParam('doShowTrends', LabelParam,
+                       label="Show resolution of the project runs",
+                       help="Plot the median resolution (with the 25-75 "
+                            "percentile band) and the mean of the ResMap "
+                            "runs of the project, in time order, from the "
+                            "results store.")
+        group.addParam('trendsRuns', IntParam, default=100,
+                       expertLevel=LEVEL_ADVANCED,
+                       label='Maximum number of runs',
+                       help='Only the most recent runs are shown.')
+
     def getImgData(self, imgFile):
-        return LocalResolutionViewer.getImgData(self, imgFile,maxMaskValue = 99.9)
+        return LocalResolutionViewer.getImgData(self, imgFile,
+                                                maxMaskValue=MAX_MASK_VALUE)
+
+    def _getResolutionRange(self):
+        """ Min and max resolution, from the region index if available
+        to avoid reading the map when the viewer opens.
+        """
+        regionIndex = self.protocol.getRegionIndex()
+        if regionIndex is not None:
+            stats = regionIndex.query()
+            if stats['count']:
+                return float(stats['min']), float(stats['max'])
+        imageFile = self.protocol._getFileName(RESMAP_VOL)
+        _, min_Res, max_Res, _ = self.getImgData(imageFile)
+        return min_Res, max_Res
+
+    # ------------------------ Background loading -----------------------------
+    def _getBackgroundDict(self):
+        """ Actions whose data is loaded in the background when the viewer
+        runs in the GUI: {param: (load(task), show(data))}. Actions sharing
+        the load function share a single load.
+        """
+        return {
+                'doShowVolumeColorSlices': (self._loadImgData,
+                                            self._plotColorSlices),
+                'doShowOneColorslice': (self._loadImgData,
+                                        self._plotOneColorslice),
+                'doShowResHistogram': (self._loadHistogram,
+                                       self._plotHistogramData),
+                'doShowChimera': (self._writeChimeraScript,
+                                  self._chimeraViews),
+                'doShowTrends': (self._loadTrends, self._plotTrends)
+            }
+
+    def _visualizeParam(self, paramName=None):
+        actions = self._getBackgroundDict()
+        if self.getTkRoot() is None or paramName not in actions:
+            return ProtocolViewer._visualizeParam(self, paramName)
+
+        errors = self.validate()
+        if errors:
+            self.showError('\n'.join(errors), "Validation errors")
+            return
+        self.protocol._createFilenameTemplates()
+        load, show = actions[paramName]
+        self._getTasks().submit(load.__name__, load,
+                                lambda data: self._showViews(show(data)),
+                                self._showTaskError)
+
+    def _getTasks(self):
+        if getattr(self, '_tasks', None) is None:
+            self._tasks = BackgroundTasks(self.getTkRoot(),
+                                          onProgress=self._updateProgress)
+            self._progressWindow = None
+        return self._tasks
+
+    def _updateProgress(self, tasks):
+        if tasks:
+            if self._progressWindow is None:
+                self._progressWindow = ProgressWindow(self.getTkRoot(),
+                                                      self._cancelTasks)
+            self._progressWindow.update(tasks)
+        elif self._progressWindow is not None:
+            self._progressWindow.close()
+            self._progressWindow = None
+
+    def _cancelTasks(self):
+        self._tasks.cancel()
+        self._updateProgress([])
+
+    def _showViews(self, views):
+        for v in views or []:
+            v.show()
+
+    def _showTaskError(self, error):
+        self.showError(str(error), "ResMap viewer")
+
+    def _readResolutionMap(self, task, maxProgress=1.0):
+        """ Read the resolution map in chunks of slices, reporting the
+        progress up to maxProgress and checking for cancellation between
+        chunks.
+        """
+        task.setProgress(0, "Reading resolution map")
+        volume = openMap(self.protocol._getFileName(RESMAP_VOL))
+        data = np.empty(volume.shape, dtype=np.float32)
+        nz = volume.shape[0]
+        for z0 in range(0, nz, READ_CHUNK):
+            data[z0:z0 + READ_CHUNK] = volume[z0:z0 + READ_CHUNK]
+            task.setProgress(maxProgress * min(z0 + READ_CHUNK, nz) / nz)
+        return data
+
+    def _loadImgData(self, task):
+        """ Read the resolution map once for all the slice actions. Return
+        the same values as getImgData.
+        """
+        if getattr(self, '_imgData', None) is None:
+            data = self._readResolutionMap(task)
+            imgData = np.ma.masked_where(data > MAX_MASK_VALUE, data,
+                                         copy=False)
+            maxRes = np.amax(imgData)
+            imgData = np.ma.masked_where(imgData < 0.1, imgData, copy=False)
+            nz, ny, nx = data.shape
+            self._imgData = imgData, np.amin(imgData), maxRes, (nx, ny, nz)
+        task.setProgress(1)
+        return self._imgData
 
     def _getVisualizeDict(self):
         self.protocol._createFilenameTemplates()
@@ -109,7 +233,8 @@ class ResMapViewer(LocalResolutionViewer):
                 'doShowVolumeColorSlices': self._showVolumeColorSlices,
                 'doShowOneColorslice': self._showOneColorslice,
                 'doShowResHistogram': self._plotHistogram,
-                'doShowChimera': self._showChimera
+                'doShowChimera': self._showChimera,
+                'doShowTrends': self._showTrends
             }
 
     def _showLogFile(self, param=None):
@@ -130,8 +255,10 @@ class ResMapViewer(LocalResolutionViewer):
 
 
     def _showVolumeColorSlices(self, param=None):
-        imageFile = self.protocol._getFileName(RESMAP_VOL)
-        imgData, _, _, _ = self.getImgData(imageFile)
+        return self._plotColorSlices(self._loadImgData(Task(param)))
+
+    def _plotColorSlices(self, data):
+        imgData, _, _, _ = data
 
         xplotter = EmPlotter(x=2, y=2, mainTitle="Local Resolution Slices "
                                                     "along %s-axis."
@@ -153,9 +280,10 @@ class ResMapViewer(LocalResolutionViewer):
         return max(data) - 1
 
     def _showOneColorslice(self, param=None):
-        imageFile = self.protocol._getFileName(RESMAP_VOL)
-        imgData, _, _, volDims = self.getImgData(imageFile)
-        print(volDims)
+        return self._plotOneColorslice(self._loadImgData(Task(param)))
+
+    def _plotOneColorslice(self, data):
+        imgData, _, _, volDims = data
         xplotter = EmPlotter(x=1, y=1, mainTitle="Local Resolution Slices "
                                                     "along %s-axis."
                                                     % self._getAxis())
@@ -174,17 +302,58 @@ class ResMapViewer(LocalResolutionViewer):
         return [xplotter]
 
     def _plotHistogram(self, param=None):
-        imageFile = self.protocol._getFileName(RESMAP_VOL)
-        img = ImageHandler().read(imageFile)
-        imgData = img.getData()
-        imgList = imgData.flatten()
-        imgDataMax = self.getBackGroundValue(imgList)
-        imgListNoZero = filter(lambda x: 0 < x < imgDataMax, imgList)
+        return self._plotHistogramData(self._loadHistogram(Task(param)))
+
+    def _loadHistogram(self, task):
+        """ Return the (counts, edges) of the resolution histogram. """
         nbins = 30
+        regionIndex = self.protocol.getRegionIndex()
+        if regionIndex is not None:
+            # Use the stored block summary instead of reading the map
+            return regionIndex.rebin(regionIndex.query()['hist'], nbins)
+
+        imgData = self._readResolutionMap(task, 0.9)
+        task.setProgress(0.9, "Computing histogram")
+        imgDataMax = imgData.max() - 1
+        values = imgData[(imgData > 0) & (imgData < imgDataMax)]
+        return np.histogram(values, nbins)
+
+    def _plotHistogramData(self, data):
+        hist, edges = data
         plotter = EmPlotter(x=1,y=1,mainTitle="  ")
-        plotter.createSubPlot("Resolution histogram",
-                              "Resolution (A)", "# of Counts")
-        plotter.plotHist(imgListNoZero, nbins)
+        a = plotter.createSubPlot("Resolution histogram",
+                                  "Resolution (A)", "# of Counts")
+        a.hist(edges[:-1], bins=edges, weights=hist, facecolor='blue')
+        return [plotter]
+
+    def _showTrends(self, param=None):
+        return self._plotTrends(self._loadTrends(Task(param)))
+
+    def _loadTrends(self, task):
+        store = self.protocol.getResultsStore()
+        return store.query(['runId', 'runName', 'mean', 'median', 'p25',
+                            'p75'],
+                           project=self.protocol.getProject().getShortName(),
+                           limit=self.trendsRuns.get())
+
+    def _plotTrends(self, rows):
+        if not rows:
+            return [self.errorMessage("No runs in the results store.",
+                                      "No results")]
+
+        plotter = EmPlotter(x=1, y=1, mainTitle="ResMap runs")
+        a = plotter.createSubPlot("Local resolution of the project runs",
+                                  "Run", "Resolution (A)")
+        x = list(range(len(rows)))
+        get = lambda key: [row[key] for row in rows]
+        a.fill_between(x, get('p25'), get('p75'), color='blue', alpha=0.2,
+                       label='25-75 percentiles')
+        a.plot(x, get('median'), 'o-', color='blue', label='median')
+        a.plot(x, get('mean'), 'x--', color='red', label='mean')
+        if len(rows) <= 30:
+            a.set_xticks(x)
+            a.set_xticklabels(get('runName'), rotation=90, fontsize=7)
+        a.legend()
         return [plotter]
 
     def _getAxis(self):
@@ -192,7 +361,10 @@ class ResMapViewer(LocalResolutionViewer):
 
 
     def _showChimera(self, param=None):
+        return self._chimeraViews(self._writeChimeraScript(Task(param)))
 
+    def _writeChimeraScript(self, task):
+        task.setProgress(0, "Writing Chimera script")
         fnResVol = self.protocol._getFileName(RESMAP_VOL)
         vol = self.protocol.volumeHalf1.get()
 
@@ -204,6 +376,9 @@ class ResMapViewer(LocalResolutionViewer):
                                  numColors=self.intervals.get(),
                                  lowResLimit=self.highest.get(),
                                  highResLimit=self.lowest.get())
+        return cmdFile
+
+    def _chimeraViews(self, cmdFile):
         view = ChimeraView(cmdFile)
         return [view]
 
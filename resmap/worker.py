@@ -0,0 +1,318 @@
+# **************************************************************************
+# *
+# * Authors:    Scipion Team (scipion@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Persistent local worker running the in-process estimation engine.
+
+Launching a new process for each estimation pays the interpreter start
+and the imports every time, and loses the kernels kept in memory by the
+spectral caches. The worker keeps them loaded and receives jobs through
+a Unix socket, so small maps are estimated with very little overhead.
+
+Requests are dicts with a 'cmd' key:
+    - ping: health check, answered even while a job is running.
+    - estimate: arguments of engine.estimateFiles.
+    - sweep: arguments of engine.sweepFiles.
+    - shutdown: stop the worker.
+
+The worker exits after some time without jobs. The socket and the
+connection key must be in a folder only accessible by the user. Clients
+start the worker holding a lock file next to the socket, so concurrent
+runs share a single worker.
+
+Usage: python -m resmap.worker [--address SOCKET] [--idle-timeout SECONDS]
+"""
+
+import argparse
+import fcntl
+import os
+import stat
+import subprocess
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client, Listener
+
+from resmap.cache import SpectralCache
+from resmap.constants import WORKER_IDLE_TIMEOUT, WORKER_START_TIMEOUT
+from resmap.engine import estimateFiles, sweepFiles
+
+
+def _getKeyFile(address):
+    return address + '.key'
+
+
+def _readKey(address):
+    with open(_getKeyFile(address), 'rb') as f:
+        return f.read()
+
+
+def checkPrivateFolder(folder):
+    """ Create the folder of the worker files if needed and check that
+    only the user can access it. Raise PermissionError otherwise.
+    """
+    os.makedirs(folder, mode=0o700, exist_ok=True)
+    info = os.lstat(folder)
+    if (not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid()
+            or info.st_mode & 0o077):
+        raise PermissionError('The ResMap worker folder %s must be owned '
+                              'and only accessible by the user.' % folder)
+
+
+@contextmanager
+def _startLock(address):
+    """ Exclusive lock serializing the start and stop of the worker. """
+    fd = os.open(address + '.lock', os.O_RDWR | os.O_CREAT | os.O_NOFOLLOW,
+                 0o600)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        os.close(fd)  # also releases the lock
+
+
+class EstimationWorker:
+    """ Serve estimation jobs on a Unix socket. Jobs run one at a time,
+    each using the threads given in its parameters.
+    """
+    def __init__(self, address, idleTimeout=WORKER_IDLE_TIMEOUT):
+        self.address = address
+        self.idleTimeout = idleTimeout
+        self.startTime = time.time()
+        self.jobs = 0
+        self._caches = {}
+        self._jobLock = threading.Lock()
+        self._lastActivity = time.time()
+        self._stopping = False
+        self._key = os.urandom(32)
+
+    def _writeKey(self):
+        keyFile = _getKeyFile(self.address)
+        if os.path.lexists(keyFile):
+            os.remove(keyFile)  # stale key of a previous worker
+        # never follow or reuse a file created by someone else
+        fd = os.open(keyFile, os.O_WRONLY | os.O_CREAT | os.O_EXCL |
+                     os.O_NOFOLLOW, 0o600)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(self._key)
+
+    def _removeFiles(self):
+        """ Remove the socket and the key, unless they already belong to
+        a newer worker.
+        """
+        with _startLock(self.address):
+            try:
+                if _readKey(self.address) != self._key:
+                    return
+            except OSError:
+                pass
+            for fn in (self.address, _getKeyFile(self.address)):
+                if os.path.lexists(fn):
+                    os.remove(fn)
+
+    def _getCache(self, cachePath):
+        """ Return the open cache of the path, keeping its memory layer
+        between jobs.
+        """
+        if cachePath not in self._caches:
+            self._caches[cachePath] = SpectralCache(cachePath)
+        return self._caches[cachePath]
+
+    def _wake(self):
+        """ Unblock the accept call of the main loop. """
+        try:
+            Client(self.address, family='AF_UNIX', authkey=self._key).close()
+        except (OSError, AuthenticationError):
+            pass
+
+    def _watchIdle(self):
+        while not self._stopping:
+            time.sleep(min(1.0, self.idleTimeout))
+            idle = time.time() - self._lastActivity
+            if idle > self.idleTimeout and not self._jobLock.locked():
+                self.stop()
+
+    def stop(self):
+        """ Stop serving after the running job, if any. """
+        if not self._stopping:
+            self._stopping = True
+            self._wake()
+
+    def status(self):
+        return {'status': 'ok', 'pid': os.getpid(),
+                'uptime': time.time() - self.startTime, 'jobs': self.jobs,
+                'busy': self._jobLock.locked()}
+
+    def _runJob(self, cmd, args):
+        func = estimateFiles if cmd == 'estimate' else sweepFiles
+        args = list(args)
+        params = dict(args[-1])
+        cachePath = params.pop('cachePath', None)
+        if cachePath:
+            params['cache'] = self._getCache(cachePath)
+        args[-1] = params
+        with self._jobLock:
+            try:
+                return func(*args)
+            finally:
+                self.jobs += 1
+                self._lastActivity = time.time()
+
+    def handle(self, request):
+        """ Return the reply to a request. """
+        self._lastActivity = time.time()
+        cmd = request.get('cmd')
+        try:
+            if cmd == 'ping':
+                return self.status()
+            if cmd in ('estimate', 'sweep'):
+                return {'status': 'ok',
+                        'result': self._runJob(cmd, request['args'])}
+            if cmd == 'shutdown':
+                return {'status': 'ok'}  # stopped once the reply is sent
+            return {'status': 'error', 'message': 'Unknown command %s' % cmd}
+        except Exception as e:
+            return {'status': 'error',
+                    'message': '%s: %s' % (type(e).__name__, e)}
+
+    def _serveConnection(self, conn):
+        with conn:
+            try:
+                while True:
+                    request = conn.recv()
+                    conn.send(self.handle(request))
+                    if request.get('cmd') == 'shutdown':
+                        self.stop()
+            except (EOFError, OSError):
+                pass  # client closed the connection
+
+    def serve(self):
+        """ Accept connections until shutdown or idle timeout. """
+        checkPrivateFolder(os.path.dirname(os.path.abspath(self.address)))
+        if os.path.lexists(self.address):
+            os.remove(self.address)  # stale socket, the caller checked it
+        listener = Listener(self.address, family='AF_UNIX',
+                            authkey=self._key)
+        self._writeKey()
+        threading.Thread(target=self._watchIdle, daemon=True).start()
+        try:
+            while not self._stopping:
+                try:
+                    conn = listener.accept()
+                except (OSError, AuthenticationError):
+                    continue  # failed connection or authentication
+                if self._stopping:
+                    conn.close()
+                    break
+                threading.Thread(target=self._serveConnection, args=(conn,),
+                                 daemon=True).start()
+        finally:
+            self._stopping = True
+            listener.close()
+            with self._jobLock:  # let the running job finish
+                self._removeFiles()
+
+
+class WorkerClient:
+    """ Send requests to a running EstimationWorker. """
+    def __init__(self, address):
+        self.address = address
+
+    def _request(self, request, timeout=None):
+        with Client(self.address, family='AF_UNIX',
+                    authkey=_readKey(self.address)) as conn:
+            conn.send(request)
+            if timeout is not None and not conn.poll(timeout):
+                raise TimeoutError('The ResMap worker did not answer.')
+            reply = conn.recv()
+        if reply['status'] != 'ok':
+            raise RuntimeError('ResMap worker: %s' % reply['message'])
+        return reply
+
+    def ping(self, timeout=5):
+        """ Return the worker status, or None if it is not alive. """
+        try:
+            return self._request({'cmd': 'ping'}, timeout)
+        except (OSError, EOFError, AuthenticationError, RuntimeError):
+            return None
+
+    def estimate(self, half1Fn, half2Fn, outFn, maskFn, params):
+        """ Same as engine.estimateFiles, run in the worker. """
+        args = [half1Fn, half2Fn, outFn, maskFn, params]
+        return self._request({'cmd': 'estimate', 'args': args})['result']
+
+    def sweep(self, half1Fn, half2Fn, outFns, maskFn, params):
+        """ Same as engine.sweepFiles, run in the worker. """
+        args = [half1Fn, half2Fn, outFns, maskFn, params]
+        return self._request({'cmd': 'sweep', 'args': args})['result']
+
+    def shutdown(self):
+        self._request({'cmd': 'shutdown'})
+
+
+def startWorker(address, idleTimeout=WORKER_IDLE_TIMEOUT,
+                timeout=WORKER_START_TIMEOUT):
+    """ Return a client of the worker at address, launching it in a
+    new detached process if it is not alive. Concurrent callers wait for
+    the worker started by the first one.
+    """
+    checkPrivateFolder(os.path.dirname(os.path.abspath(address)))
+    client = WorkerClient(address)
+    with _startLock(address):
+        if client.ping() is not None:
+            return client
+
+        subprocess.Popen([sys.executable, '-m', 'resmap.worker',
+                          '--address', address,
+                          '--idle-timeout', str(idleTimeout)],
+                         stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                         stderr=subprocess.DEVNULL, start_new_session=True,
+                         # importable also from a source tree
+                         cwd=os.path.dirname(os.path.dirname(
+                             os.path.abspath(__file__))))
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            time.sleep(0.2)
+            if client.ping() is not None:
+                return client
+    raise TimeoutError('The ResMap worker did not start in %d seconds.'
+                       % timeout)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--address', required=True,
+                        help='Unix socket of the worker.')
+    parser.add_argument('--idle-timeout', type=float,
+                        default=WORKER_IDLE_TIMEOUT,
+                        help='Seconds without jobs before exiting.')
+    args = parser.parse_args()
+    EstimationWorker(args.address, args.idle_timeout).serve()
+
+
+if __name__ == '__main__':
+    main()